@@ -0,0 +1,316 @@
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+    import fcntl
+
+JOURNAL_NAME = 'attendance_journal.jsonl'
+SNAPSHOT_NAME = 'attendance_snapshot.jsonl'
+FIELDS = ['Date', 'Day', 'Time', 'Computer Name', 'User', 'Event', 'Status']
+
+# The journal is folded into the snapshot once it grows past this size
+COMPACT_BYTES = 1024 * 1024
+
+# Log files are split into one segment per 'month' (default) or per 'day'
+PARTITION = os.environ.get('ATTENDANCE_PARTITION', 'month')
+
+def current_period(when=None):
+    """Name of the segment period a moment falls in, such as 2026-10 (or 2026-10-18 per day)"""
+    return (when or datetime.now()).strftime('%Y-%m-%d' if PARTITION == 'day' else '%Y-%m')
+
+def segment_name(name, period):
+    """'attendance_log.csv' becomes 'attendance_log-2026-10.csv'; an empty period keeps the plain name"""
+    if not period:
+        return name
+    stem, ext = os.path.splitext(name)
+    return f"{stem}-{period}{ext}"
+
+def default_logs_dir():
+    """The project's logs folder, next to the folder holding the scripts (or the frozen exe)"""
+    if getattr(sys, 'frozen', False):
+        script_dir = os.path.dirname(sys.executable)
+    else:
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(os.path.dirname(script_dir), 'logs')
+
+@contextmanager
+def file_lock(lock_path):
+    """Exclusive lock shared by every process writing the files guarded by lock_path"""
+    with open(lock_path, 'a+b') as f:
+        if msvcrt:
+            # msvcrt locks a byte range; LK_LOCK gives up after 10 seconds, so keep trying
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.05)
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def parse_lines(f):
+    """Records from JSON lines, skipping a torn last line left by a crash mid-write"""
+    for line in f:
+        if not line.endswith(b'\n'):
+            break
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line.decode('utf-8'))
+        except ValueError:
+            continue
+
+class AttendanceJournal:
+    """Append-only JSON-lines journal of the attendance records of one period
+
+    Appending writes one line at the end of the journal, so it costs the
+    same however long the history is. Lines are fsynced once every
+    `sync_every` records and on flush()/close(). compact() folds the
+    journal into a snapshot file and starts a new, empty journal; the
+    snapshot remembers which journal it consumed and up to which offset,
+    so a crash between the two steps never duplicates records.
+
+    period defaults to the current one; '' is the unpartitioned journal
+    written before logs were split into segments.
+    """
+
+    def __init__(self, logs_dir=None, sync_every=1, period=None):
+        self.logs_dir = logs_dir or default_logs_dir()
+        self.period = current_period() if period is None else period
+        self.path = os.path.join(self.logs_dir, segment_name(JOURNAL_NAME, self.period))
+        self.snapshot_path = os.path.join(self.logs_dir, segment_name(SNAPSHOT_NAME, self.period))
+        self.lock_path = self.path + '.lock'
+        self.sync_every = max(1, sync_every)
+        self.pending = 0
+        self._file = None
+
+    def exists(self):
+        return os.path.exists(self.path) or os.path.exists(self.snapshot_path)
+
+    def _write_header(self, path, header):
+        with open(path, 'wb') as f:
+            f.write((json.dumps(header) + '\n').encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _current_file(self):
+        # Caller holds the lock. compact() may have replaced the journal since it was opened
+        if self._file is not None:
+            try:
+                if os.fstat(self._file.fileno()).st_ino == os.stat(self.path).st_ino:
+                    return self._file
+            except OSError:
+                pass
+            self._close_file()
+
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            os.makedirs(self.logs_dir, exist_ok=True)
+            self._write_header(self.path, {'journal': uuid.uuid4().hex})
+        self._file = open(self.path, 'ab')
+        return self._file
+
+    def _sync(self):
+        if self._file is not None and self.pending:
+            os.fsync(self._file.fileno())
+            self.pending = 0
+
+    def _close_file(self):
+        self._sync()
+        self._file.close()
+        self._file = None
+
+    def append(self, record):
+        self.append_many([record])
+
+    def append_many(self, records):
+        """Append records; other processes may append concurrently"""
+        data = b''.join((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8') for record in records)
+        with file_lock(self.lock_path):
+            f = self._current_file()
+            # A writer that crashed mid-line left a torn tail; end it so it cannot swallow our first record
+            with open(self.path, 'rb') as tail:
+                tail.seek(-1, os.SEEK_END)
+                if tail.read(1) != b'\n':
+                    data = b'\n' + data
+            f.write(data)
+            f.flush()
+            self.pending += len(records)
+            if self.pending >= self.sync_every:
+                self._sync()
+
+    def flush(self):
+        with file_lock(self.lock_path):
+            self._sync()
+
+    def close(self):
+        if self._file is not None:
+            with file_lock(self.lock_path):
+                self._close_file()
+
+    def records(self):
+        """Every record, oldest first"""
+        consumed_journal, consumed_offset = None, 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as f:
+                header = json.loads(f.readline().decode('utf-8'))
+                consumed_journal, consumed_offset = header.get('journal'), header.get('offset', 0)
+                for record in parse_lines(f):
+                    yield record
+
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                header_line = f.readline()
+                header = json.loads(header_line.decode('utf-8')) if header_line.endswith(b'\n') else {}
+                # The snapshot already holds the start of this journal if compaction was interrupted
+                if consumed_journal and header.get('journal') == consumed_journal:
+                    f.seek(max(consumed_offset, len(header_line)))
+                for record in parse_lines(f):
+                    yield record
+
+    def position(self):
+        """(id, size) of the current journal file, or (None, 0) while there is none"""
+        if not os.path.exists(self.path):
+            return None, 0
+        with open(self.path, 'rb') as f:
+            header_line = f.readline()
+            if not header_line.endswith(b'\n'):
+                return None, 0
+            return json.loads(header_line.decode('utf-8')).get('journal'), os.fstat(f.fileno()).st_size
+
+    def read_since(self, journal_id, offset):
+        """(records appended after offset, offset reached) while journal_id is still the journal
+
+        Returns None once it was replaced by compact(), or for no journal_id.
+        Only complete lines are read; a record being written comes next time.
+        """
+        if not journal_id or not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            header_line = f.readline()
+            if not header_line.endswith(b'\n') or \
+                    json.loads(header_line.decode('utf-8')).get('journal') != journal_id:
+                return None
+            if offset < len(header_line) or offset > os.fstat(f.fileno()).st_size:
+                return None
+            f.seek(offset)
+            data = f.read()
+        data = data[:data.rfind(b'\n') + 1]
+        return list(parse_lines(io.BytesIO(data))), offset + len(data)
+
+    def compact(self):
+        """Fold the journal into the snapshot and start a new journal; returns the record count"""
+        with file_lock(self.lock_path):
+            if self._file is not None:
+                self._close_file()
+
+            journal_id, journal_size = None, 0
+            if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+                with open(self.path, 'rb') as f:
+                    journal_id = json.loads(f.readline().decode('utf-8')).get('journal')
+                journal_size = os.path.getsize(self.path)
+
+            count = 0
+            with open(self.snapshot_path + '.tmp', 'wb') as f:
+                f.write((json.dumps({'journal': journal_id, 'offset': journal_size}) + '\n').encode('utf-8'))
+                for record in self.records():
+                    f.write((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+                    count += 1
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.snapshot_path + '.tmp', self.snapshot_path)
+
+            self._write_header(self.path + '.tmp', {'journal': uuid.uuid4().hex})
+            os.replace(self.path + '.tmp', self.path)
+            return count
+
+    def maybe_compact(self, max_bytes=COMPACT_BYTES):
+        """Compact once the journal has grown past max_bytes; the cost is spread over many appends"""
+        if os.path.exists(self.path) and os.path.getsize(self.path) > max_bytes:
+            return self.compact()
+        return None
+
+def export_json(records, path):
+    """Write records as one JSON array, in the format attendance_log.json always had"""
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write('[')
+        count = 0
+        for record in records:
+            f.write(',\n  ' if count else '\n  ')
+            f.write(json.dumps(record, indent=2, ensure_ascii=False).replace('\n', '\n  '))
+            count += 1
+        f.write('\n]' if count else ']')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+def export_csv(records, path):
+    with open(path + '.tmp', 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+        for record in records:
+            writer.writerow([record.get(field, '') for field in FIELDS])
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Attendance journal maintenance and exports')
+    parser.add_argument('--logs-dir', help='folder holding the journal (default: the project logs folder)')
+    commands = parser.add_subparsers(dest='command')
+    export = commands.add_parser('export', help='write the records as a JSON or CSV file')
+    export.add_argument('--format', choices=('json', 'csv'), default='json')
+    export.add_argument('--output', help='file to write (default: attendance_log.<format> in the logs folder)')
+    export.add_argument('--period', help='only this period (such as 2026-10) instead of the whole history')
+    commands.add_parser('compact', help="fold the current period's journal into its snapshot")
+    commands.add_parser('rotate', help='archive the segments of closed periods')
+    commands.add_parser('count', help='print the number of records')
+    args = parser.parse_args(argv)
+
+    # Reading across segments needs the archive manifest
+    import attendance_segments
+
+    logs_dir = args.logs_dir or default_logs_dir()
+    if args.command == 'export':
+        output = args.output or os.path.join(logs_dir, 'attendance_log.' + args.format)
+        records = attendance_segments.all_records(logs_dir, args.period)
+        if args.format == 'json':
+            export_json(records, output)
+        else:
+            export_csv(records, output)
+        print(f"Exported to {output}")
+    elif args.command == 'compact':
+        print(f"Compacted {AttendanceJournal(logs_dir).compact()} records")
+    elif args.command == 'rotate':
+        archived = attendance_segments.rotate_segments(logs_dir, force=True)
+        print(f"Archived {len(archived)} segments")
+    elif args.command == 'count':
+        print(sum(1 for _ in attendance_segments.all_records(logs_dir)))
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,285 @@
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import re
+import sqlite3
+import sys
+
+from attendance_journal import (AttendanceJournal, FIELDS, SNAPSHOT_NAME, default_logs_dir, file_lock, parse_lines,
+                                segment_name)
+from attendance_segments import SEGMENT_PATTERN, load_manifest
+
+INDEX_NAME = 'attendance_index.sqlite'
+CSV_NAME = 'attendance_log.csv'
+
+# Bumped whenever the tables change; an older index is rebuilt from the logs
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    source TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    time TEXT NOT NULL,
+    day TEXT,
+    computer TEXT NOT NULL,
+    user TEXT NOT NULL,
+    event TEXT NOT NULL,
+    status TEXT,
+    PRIMARY KEY (source, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS records_by_date ON records (date, time);
+CREATE INDEX IF NOT EXISTS records_by_user ON records (user, date);
+CREATE INDEX IF NOT EXISTS records_by_computer ON records (computer, date);
+CREATE TABLE IF NOT EXISTS sources (
+    key TEXT PRIMARY KEY,
+    marker TEXT,
+    offset INTEGER NOT NULL,
+    count INTEGER NOT NULL
+);
+"""
+
+GROUP_COLUMNS = {'date': 'date', 'user': 'user', 'computer': 'computer', 'event': 'event',
+                 'month': "substr(date, 1, 7)"}
+
+def record_row(record):
+    """records table columns of a journal record or CSV row, or None if it lacks a date or time"""
+    if not record.get('Date') or not record.get('Time'):
+        return None
+    return (record['Date'], record['Time'], record.get('Day'), record.get('Computer Name') or '',
+            record.get('User') or '', record.get('Event') or '', record.get('Status'))
+
+def archive_copy(entry):
+    """0 for the first archive of a segment, n for the copy archived as name.n.ext.gz"""
+    stem, ext = os.path.splitext(entry['source'])
+    match = re.match(re.escape(stem) + r'\.(\d+)' + re.escape(ext) + r'\.gz$', entry['file'])
+    return int(match.group(1)) if match else 0
+
+class AttendanceIndex:
+    """SQLite index of the attendance records, kept in step with the log files
+
+    Every record is indexed once, from the source of truth of its period:
+    the journal (its snapshot and open file, or the archived snapshot)
+    where the period has one, otherwise its CSV log, as for the legacy
+    log and periods marked only by mark_attendance.py. A record is known
+    by its source and its position in it, never by its contents, so two
+    logins in the same second are two records.
+
+    Open sources are read from where the previous update stopped, so an
+    update costs only the records appended since. A compacted journal, or
+    a CSV whose first line changed or that shrank, is indexed again from
+    the start. Queries use the per date, per user and per computer
+    indexes, so they do not scan the whole history.
+    """
+
+    def __init__(self, logs_dir=None, index_path=None):
+        self.logs_dir = logs_dir or default_logs_dir()
+        self.index_path = index_path or os.path.join(self.logs_dir, INDEX_NAME)
+        self.db = sqlite3.connect(self.index_path)
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            # The index only mirrors the logs, so an older layout is simply rebuilt
+            self.db.executescript('DROP TABLE IF EXISTS records; DROP TABLE IF EXISTS sources;')
+            self.db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def sources(self):
+        """(key, kind, source) of each period's source of truth: its journal, or its CSV log if it has none
+
+        kind is 'journal' for an open journal (source is the AttendanceJournal)
+        and 'jsonl' or 'csv' for a file path. A segment keeps its key when it
+        is archived, so its records are not indexed twice.
+        """
+        snapshot_stem = os.path.splitext(SNAPSHOT_NAME)[0]
+        csv_stem = os.path.splitext(CSV_NAME)[0]
+        periods = {}
+        archived = {}
+        for entry in load_manifest(self.logs_dir)['segments']:
+            copy = archive_copy(entry)
+            archived[entry['source']] = max(archived.get(entry['source'], 0), copy + 1)
+            if entry['kind'] == 'jsonl' and entry['source'].startswith(snapshot_stem + '-') or \
+                    entry['kind'] == 'csv' and entry['source'].startswith(csv_stem + '-'):
+                periods.setdefault(entry['period'], []).append(
+                    (f"{entry['source']}#{copy}", entry['kind'], os.path.join(self.logs_dir, entry['file'])))
+
+        open_periods = {''}
+        for name in os.listdir(self.logs_dir):
+            match = SEGMENT_PATTERN.match(name)
+            if match and match.group('ext') in ('.csv', '.jsonl'):
+                open_periods.add(match.group('period'))
+        for period in sorted(open_periods):
+            journal = AttendanceJournal(self.logs_dir, period=period)
+            if journal.exists():
+                name = segment_name(SNAPSHOT_NAME, period)
+                periods.setdefault(period, []).append((f"{name}#{archived.get(name, 0)}", 'journal', journal))
+            name = segment_name(CSV_NAME, period)
+            if os.path.exists(os.path.join(self.logs_dir, name)):
+                periods.setdefault(period, []).append(
+                    (f"{name}#{archived.get(name, 0)}", 'csv', os.path.join(self.logs_dir, name)))
+
+        sources = []
+        for period in sorted(periods):
+            journals = [source for source in periods[period] if source[1] != 'csv']
+            sources += journals or periods[period]
+        return sources
+
+    def update(self):
+        """Index whatever was appended to the log files since the last update; returns rows added"""
+        added = 0
+        with self.db:
+            keys = set()
+            for key, kind, source in self.sources():
+                keys.add(key)
+                added += self._update_source(key, kind, source)
+            # Sources no longer followed, such as the CSV of a period that now has a journal
+            for (key,) in self.db.execute('SELECT key FROM sources').fetchall():
+                if key not in keys:
+                    self.db.execute('DELETE FROM records WHERE source = ?', (key,))
+                    self.db.execute('DELETE FROM sources WHERE key = ?', (key,))
+        return added
+
+    def _update_source(self, key, kind, source):
+        stored = self.db.execute('SELECT marker, offset, count FROM sources WHERE key = ?', (key,)).fetchone()
+        if kind == 'journal':
+            since = source.read_since(stored[0], stored[1]) if stored else None
+            if since is not None:
+                records, offset = since
+                return self._index_records(key, stored[0], offset, stored, records)
+            with file_lock(source.lock_path):
+                records = list(source.records())
+                journal_id, offset = source.position()
+            return self._index_records(key, journal_id, offset, stored, records, again=True)
+
+        if source.endswith('.gz'):
+            # Archives never change, so each is read once; the open file it came from may have grown since
+            if stored and stored[0] == 'archive':
+                return 0
+            with gzip.open(source, 'rb') as f:
+                header = f.readline()
+                data = f.read()
+            if kind == 'jsonl':
+                return self._index_records(key, 'archive', 0, stored, parse_lines(io.BytesIO(data)), again=True)
+            return self._index_records(key, 'archive', 0, stored, self._csv_records(header, data, True), again=True)
+
+        with open(source, 'rb') as f:
+            header = f.readline()
+            if not header.endswith(b'\n'):
+                return 0
+            again = not (stored and stored[0] == header.decode('utf-8') and stored[1] <= os.fstat(f.fileno()).st_size)
+            offset = len(header) if again else stored[1]
+            f.seek(offset)
+            data = f.read()
+
+        # Only complete lines; a line still being written is picked up next time
+        data = data[:data.rfind(b'\n') + 1]
+        return self._index_records(key, header.decode('utf-8'), offset + len(data), stored,
+                                   self._csv_records(header, data, again), again=again)
+
+    def _csv_records(self, header, data, from_start):
+        columns = next(csv.reader([header.decode('utf-8-sig')]))
+        if columns[:1] != FIELDS[:1]:
+            # A CSV the old .tmp code left without its header: the first line is a row too
+            columns = FIELDS
+            if from_start:
+                data = header + data
+        return csv.DictReader(io.StringIO(data.decode('utf-8')), fieldnames=columns)
+
+    def _index_records(self, key, marker, offset, stored, records, again=False):
+        """Index records as the next ones of source key, or as all of them when again; returns rows added"""
+        first = 0 if again or not stored else stored[2]
+        if again:
+            self.db.execute('DELETE FROM records WHERE source = ?', (key,))
+        count = first
+        rows = []
+        for record in records:
+            row = record_row(record)
+            if row:
+                rows.append((key, count) + row)
+            # Records without a date still take their position, so positions stay the same on a reread
+            count += 1
+        self.db.executemany('INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.db.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)', (key, marker, offset, count))
+        return max(0, count - (stored[2] if stored else 0))
+
+    def who(self, date_from, date_to=None):
+        """Users seen per day in a date range, with their first and last event time"""
+        return self.db.execute(
+            'SELECT date, user, computer, min(time), max(time), count(*) FROM records '
+            'WHERE date BETWEEN ? AND ? GROUP BY date, user, computer ORDER BY date, min(time)',
+            (date_from, date_to or date_from)).fetchall()
+
+    def hours(self, date_from, date_to=None, user=None):
+        """Hours per user between their first and last event of each day, summed over the range"""
+        query = ('SELECT user, count(*), round(sum(seconds) / 3600.0, 2) FROM ('
+                 '  SELECT user, date, strftime(\'%s\', max(time)) - strftime(\'%s\', min(time)) AS seconds'
+                 '  FROM records WHERE date BETWEEN ? AND ?' + (' AND user = ?' if user else '') +
+                 '  GROUP BY user, date) GROUP BY user ORDER BY user')
+        params = (date_from, date_to or date_from) + ((user,) if user else ())
+        return self.db.execute(query, params).fetchall()
+
+    def count(self, group_by, date_from=None, date_to=None):
+        """Record counts grouped by one or more of date, month, user, computer and event"""
+        columns = [GROUP_COLUMNS[name] for name in group_by]
+        where, params = '', ()
+        if date_from:
+            where, params = 'WHERE date BETWEEN ? AND ?', (date_from, date_to or '9999-12-31')
+        select = ', '.join(columns)
+        return self.db.execute(f'SELECT {select}, count(*) FROM records {where} '
+                               f'GROUP BY {select} ORDER BY {select}', params).fetchall()
+
+def month_range(month):
+    """First and last date string of a YYYY-MM month (as a string range)"""
+    return month + '-01', month + '-31'
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query the attendance logs through an incremental index')
+    parser.add_argument('--logs-dir', help='folder holding the logs (default: the project logs folder)')
+    parser.add_argument('--json', action='store_true', help='print rows as JSON instead of tab separated text')
+    commands = parser.add_subparsers(dest='command')
+    who = commands.add_parser('who', help='who logged in on a date or date range')
+    who.add_argument('date', help='YYYY-MM-DD')
+    who.add_argument('until', nargs='?', help='last date of the range')
+    hours = commands.add_parser('hours', help='hours per user in a month')
+    hours.add_argument('month', help='YYYY-MM')
+    hours.add_argument('--user')
+    count = commands.add_parser('count', help='record counts grouped by columns')
+    count.add_argument('--by', default='date', help='comma separated: date, month, user, computer, event')
+    count.add_argument('--from', dest='date_from')
+    count.add_argument('--to', dest='date_to')
+    commands.add_parser('update', help='only bring the index up to date')
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.print_help()
+        return 1
+
+    index = AttendanceIndex(args.logs_dir)
+    try:
+        added = index.update()
+        if args.command == 'update':
+            print(f"Indexed {added} new records")
+            return 0
+        elif args.command == 'who':
+            rows = index.who(args.date, args.until)
+        elif args.command == 'hours':
+            rows = index.hours(*month_range(args.month), user=args.user)
+        else:
+            group_by = [name.strip() for name in args.by.split(',') if name.strip()]
+            unknown = [name for name in group_by if name not in GROUP_COLUMNS]
+            if unknown:
+                parser.error(f"Unknown group column {', '.join(unknown)}")
+            rows = index.count(group_by, args.date_from, args.date_to)
+    finally:
+        index.close()
+
+    for row in rows:
+        print(json.dumps(row) if args.json else '\t'.join(str(value) for value in row))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
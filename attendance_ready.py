@@ -0,0 +1,59 @@
+import getpass
+import os
+import socket
+import tempfile
+import time
+
+# Longest wait for the system to become ready at login before marking anyway
+READY_TIMEOUT = float(os.environ.get('ATTENDANCE_READY_TIMEOUT', '20'))
+
+def current_user():
+    """Login name of the user, or None while it cannot be told yet"""
+    try:
+        return os.getlogin()
+    except OSError:
+        pass
+    try:
+        return getpass.getuser()
+    except Exception:
+        return None
+
+def logs_dir_writable(logs_dir):
+    try:
+        os.makedirs(logs_dir, exist_ok=True)
+        with tempfile.TemporaryFile(dir=logs_dir):
+            pass
+        return True
+    except OSError:
+        return False
+
+def hostname_resolvable():
+    try:
+        return bool(socket.getaddrinfo(socket.gethostname(), None))
+    except OSError:
+        return False
+
+def wait_until_ready(logs_dir, timeout=None, first_delay=0.05, max_delay=1.0, log=None):
+    """Poll until the logs folder is writable, the hostname resolves and the user is known
+
+    Returns as soon as every check passes, which at a normal login is on
+    the first try. Failing checks are polled again after 50 ms, doubling
+    up to max_delay, until timeout seconds have passed. Returns the names
+    of the checks still failing then (an empty list when ready).
+    """
+    deadline = time.monotonic() + (READY_TIMEOUT if timeout is None else timeout)
+    pending = {
+        'logs folder writable': lambda: logs_dir_writable(logs_dir),
+        'hostname resolvable': hostname_resolvable,
+        'user known': lambda: current_user() is not None
+    }
+    delay = first_delay
+    while True:
+        pending = {name: check for name, check in pending.items() if not check()}
+        remaining = deadline - time.monotonic()
+        if not pending or remaining <= 0:
+            return list(pending)
+        if log:
+            log(f"Waiting {delay:.2f}s for: {', '.join(pending)}")
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
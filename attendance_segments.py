@@ -0,0 +1,148 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+from datetime import datetime
+
+from attendance_journal import (AttendanceJournal, JOURNAL_NAME, SNAPSHOT_NAME, current_period,
+                                default_logs_dir, file_lock, parse_lines)
+from attendance_views import refresh_views, state_path
+
+MANIFEST_NAME = 'attendance_manifest.json'
+
+# name-PERIOD.ext of an open segment, e.g. attendance_log-2026-10.csv
+SEGMENT_PATTERN = re.compile(r'^(?P<stem>attendance_\w+)-(?P<period>\d{4}-\d{2}(?:-\d{2})?)(?P<ext>\.csv|\.txt|\.jsonl)$')
+
+def manifest_path(logs_dir):
+    return os.path.join(logs_dir, MANIFEST_NAME)
+
+def load_manifest(logs_dir):
+    path = manifest_path(logs_dir)
+    if not os.path.exists(path):
+        return {'current_period': None, 'segments': []}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_manifest(logs_dir, manifest):
+    path = manifest_path(logs_dir)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+def archive_segment(path, period):
+    """Gzip a closed segment next to itself, remove the original and return its manifest entry"""
+    directory, name = os.path.split(path)
+    stem, ext = os.path.splitext(name)
+    archive = path + '.gz'
+    copy = 1
+    while os.path.exists(archive):
+        # The period was archived before and something was written to it since
+        archive = os.path.join(directory, f"{stem}.{copy}{ext}.gz")
+        copy += 1
+
+    digest = hashlib.sha256()
+    lines = 0
+    with open(path, 'rb') as source, gzip.open(archive + '.tmp', 'wb') as target:
+        for chunk in iter(lambda: source.read(1024 * 1024), b''):
+            digest.update(chunk)
+            lines += chunk.count(b'\n')
+            target.write(chunk)
+    with open(archive + '.tmp', 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(archive + '.tmp', archive)
+
+    entry = {
+        'file': os.path.basename(archive),
+        'source': name,
+        'kind': ext.lstrip('.'),
+        'period': period,
+        'lines': lines,
+        'bytes': os.path.getsize(path),
+        'compressed_bytes': os.path.getsize(archive),
+        'sha256': digest.hexdigest(),
+        'archived_at': datetime.now().isoformat(timespec='seconds')
+    }
+    os.remove(path)
+    if os.path.exists(path + '.lock'):
+        os.remove(path + '.lock')
+    return entry
+
+def rotate_segments(logs_dir=None, period=None, force=False):
+    """Archive the segments of every period before the current one
+
+    The manifest remembers the period it last rotated for, so the usual
+    call costs one small file read. The TXT and CSV logs of closed
+    periods are brought up to date and their journals compacted into the
+    snapshot first, so each closed period ends up as one compressed
+    snapshot plus its compressed CSV and TXT logs.
+    Returns the new manifest entries.
+    """
+    logs_dir = logs_dir or default_logs_dir()
+    period = period or current_period()
+    if not force and load_manifest(logs_dir).get('current_period') == period:
+        return []
+
+    with file_lock(manifest_path(logs_dir) + '.lock'):
+        manifest = load_manifest(logs_dir)
+        if not force and manifest.get('current_period') == period:
+            return []
+
+        def closed_segments():
+            for name in sorted(os.listdir(logs_dir)):
+                match = SEGMENT_PATTERN.match(name)
+                if match and match.group('period') < period:
+                    yield name, match
+
+        for name, match in list(closed_segments()):
+            if name == f"{os.path.splitext(JOURNAL_NAME)[0]}-{match.group('period')}.jsonl":
+                refresh_views(logs_dir, match.group('period'))
+                views_state = state_path(logs_dir, match.group('period'))
+                for leftover in (views_state, views_state + '.lock'):
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+
+                journal = AttendanceJournal(logs_dir, period=match.group('period'))
+                journal.compact()
+                with file_lock(journal.lock_path):
+                    os.remove(journal.path)
+                os.remove(journal.lock_path)
+
+        archived = [archive_segment(os.path.join(logs_dir, name), match.group('period'))
+                    for name, match in closed_segments()]
+        manifest['segments'] = sorted(manifest['segments'] + archived, key=lambda e: (e['period'], e['file']))
+        manifest['current_period'] = period
+        save_manifest(logs_dir, manifest)
+        return archived
+
+def read_archive(path):
+    """Records of an archived journal snapshot, without its header line"""
+    with gzip.open(path, 'rb') as f:
+        f.readline()
+        for record in parse_lines(f):
+            yield record
+
+def all_records(logs_dir=None, period=None):
+    """Every journal record, oldest period first: the unpartitioned journal, archives, then open segments"""
+    logs_dir = logs_dir or default_logs_dir()
+    snapshot_stem = os.path.splitext(SNAPSHOT_NAME)[0]
+
+    if period is None:
+        for record in AttendanceJournal(logs_dir, period='').records():
+            yield record
+
+    for entry in load_manifest(logs_dir)['segments']:
+        if entry['source'].startswith(snapshot_stem + '-') and period in (None, entry['period']):
+            for record in read_archive(os.path.join(logs_dir, entry['file'])):
+                yield record
+
+    open_periods = set()
+    for name in os.listdir(logs_dir):
+        match = SEGMENT_PATTERN.match(name)
+        if match and match.group('ext') == '.jsonl' and period in (None, match.group('period')):
+            open_periods.add(match.group('period'))
+    for open_period in sorted(open_periods):
+        for record in AttendanceJournal(logs_dir, period=open_period).records():
+            yield record
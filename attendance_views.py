@@ -0,0 +1,267 @@
+import argparse
+import csv
+import io
+import json
+import os
+import shutil
+import sys
+from contextlib import ExitStack
+
+from attendance_journal import (AttendanceJournal, FIELDS, current_period, default_logs_dir, export_json,
+                                file_lock, segment_name)
+
+VIEWS_STATE_NAME = 'attendance_views.json'
+TXT_NAME = 'attendance_log.txt'
+CSV_NAME = 'attendance_log.csv'
+JSON_NAME = 'attendance_log.json'
+
+COPY_CHUNK_BYTES = 1024 * 1024
+
+def format_txt(records):
+    """(header, one entry per record) of the TXT view, laid out the way attendance_log.txt always was"""
+    header = "=" * 80 + "\n" + "ATTENDANCE LOG\n" + "=" * 80 + "\n\n"
+    entries = [f"Date: {record.get('Date', '')} ({record.get('Day', '')})\n"
+                f"Time: {record.get('Time', '')}\n"
+                f"User: {record.get('User', '')}\n"
+                f"Computer: {record.get('Computer Name', '')}\n"
+                f"Event: {record.get('Event', '')}\n"
+                f"Status: {record.get('Status', '')}\n" +
+                "-" * 80 + "\n\n" for record in records]
+    # The TXT log was written in text mode, so it has the platform's line endings
+    return (header.replace('\n', os.linesep).encode('utf-8'),
+            [entry.replace('\n', os.linesep).encode('utf-8') for entry in entries])
+
+def csv_row(values):
+    line = io.StringIO()
+    csv.writer(line).writerow(values)
+    return line.getvalue().encode('utf-8')
+
+def format_csv(records):
+    """(header, one row per record) of the CSV view"""
+    return csv_row(FIELDS), [csv_row([record.get(field, '') for field in FIELDS]) for record in records]
+
+VIEWS = {'txt': (TXT_NAME, format_txt), 'csv': (CSV_NAME, format_csv)}
+
+def state_path(logs_dir, period):
+    return os.path.join(logs_dir, segment_name(VIEWS_STATE_NAME, period))
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {'records': 0, 'sizes': {}}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_state(path, state):
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+def write_log(path, header, data):
+    """Append data to a log file whose lock the caller holds; returns the new size
+
+    An empty file gets the header first. The cost does not depend on how
+    long the log is.
+    """
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if size:
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                # A writer stopped mid-line; end that line so it does not swallow ours
+                data = (b'\r\n' if header.endswith(b'\r\n') else b'\n') + data
+    else:
+        data = header + data
+
+    with open(path, 'ab') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+def rewrite_log(path, header, data):
+    """Replace a log with header + its current contents + data, copying it in chunks
+
+    The new file is swapped in with a rename, so readers see either the
+    old or the new file, never a half-written one.
+    """
+    temp = path + '.rewrite'
+    with open(path, 'rb') as source, open(temp, 'wb') as target:
+        target.write(header)
+        shutil.copyfileobj(source, target, COPY_CHUNK_BYTES)
+        target.write(data)
+        target.flush()
+        os.fsync(target.fileno())
+        size = target.tell()
+    os.replace(temp, path)
+    if hasattr(os, 'O_DIRECTORY'):
+        # Make the rename itself durable
+        directory = os.open(os.path.dirname(path) or '.', os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+    return size
+
+def append_csv(path, rows):
+    """Append rows to a CSV log, safe against other processes appending to it at the same time"""
+    with file_lock(path + '.lock'):
+        return write_log(path, csv_row(FIELDS), b''.join(csv_row(row) for row in rows))
+
+def repair_csv(path):
+    """Put the header line back on a CSV log that lost it; returns False if it already had one
+
+    The old .tmp code of mark_attendance_safe.py left attendance_log.csv
+    without a header. The file is copied once in chunks behind the header.
+    """
+    header = csv_row(FIELDS)
+    with file_lock(path + '.lock'):
+        if os.path.getsize(path) == 0:
+            write_log(path, header, b'')
+            return True
+        with open(path, 'rb') as f:
+            start = f.read(len(header))
+            if start == header:
+                return False
+            f.seek(-1, os.SEEK_END)
+            # End a torn last line so the file stays one row per line
+            ending = b'' if f.read(1) == b'\n' else b'\r\n'
+        rewrite_log(path, header, ending)
+        return True
+
+def entries_written(path, start, entries):
+    """How many of entries, in order, the view holds from byte start on"""
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb') as f:
+        f.seek(start)
+        written = f.read(sum(len(entry) for entry in entries))
+    count = 0
+    for entry in entries:
+        if not written.startswith(entry):
+            break
+        written = written[len(entry):]
+        count += 1
+    return count
+
+def refresh_views(logs_dir=None, period=None):
+    """Append the journal records of a period that its TXT and CSV views do not hold yet
+
+    The journal is the only file written while attendance is marked; the
+    views follow it from here. The state file records which journal the
+    views follow and up to which offset, and how many records they hold.
+    A refresh reads only the journal lines past that offset; the whole
+    period is read once more only after the journal was compacted or a
+    view was removed or cut short.
+
+    Views are written under their locks, which append_csv() shares, and
+    what is about to be written where is saved in the state first. A
+    refresh that crashed half way is finished by the next one from that
+    record, so neither other writers' rows nor identical rows of our own
+    are mistaken for each other. Returns the number of records added.
+    """
+    logs_dir = logs_dir or default_logs_dir()
+    period = period or current_period()
+    path = state_path(logs_dir, period)
+    with file_lock(path + '.lock'):
+        state = load_state(path)
+        journal = AttendanceJournal(logs_dir, period=period)
+        views = {kind: os.path.join(logs_dir, segment_name(name, period)) for kind, (name, _) in VIEWS.items()}
+        pending = state.get('pending', {})
+
+        # Record number each view needs next
+        done = state['records']
+        needed = {}
+        for kind, view in views.items():
+            size = os.path.getsize(view) if os.path.exists(view) else 0
+            if kind in pending and size >= pending[kind]['size']:
+                needed[kind] = pending[kind]['first']
+            elif kind not in pending and os.path.exists(view) and size >= state['sizes'].get(kind, 0):
+                needed[kind] = done
+            else:
+                # The view was removed or cut short: append the whole period to what is left
+                needed[kind] = 0
+
+        since = None
+        if min(needed.values()) >= done:
+            since = journal.read_since(state.get('journal'), state.get('offset', 0))
+        if since is not None:
+            batch, journal_offset = since
+            journal_id, first = state['journal'], done
+        else:
+            # First refresh, a compacted journal or a damaged view: count through the whole period once
+            with file_lock(journal.lock_path):
+                batch = list(journal.records())
+                journal_id, journal_offset = journal.position()
+            first = 0
+        total = first + len(batch)
+
+        with ExitStack() as locks:
+            for view in views.values():
+                locks.enter_context(file_lock(view + '.lock'))
+
+            writes = {}
+            for kind, (_, formatter) in VIEWS.items():
+                view = views[kind]
+                header, entries = formatter(batch[needed[kind] - first:])
+                if needed[kind] and kind in pending:
+                    # Skip what the crashed refresh did write, in order, from where it started
+                    skip = entries_written(view, pending[kind]['start'], entries[:pending[kind]['count']])
+                    entries = entries[skip:]
+                if not entries:
+                    continue
+
+                size = os.path.getsize(view) if os.path.exists(view) else 0
+                lead = header
+                if size:
+                    with open(view, 'rb') as f:
+                        f.seek(-1, os.SEEK_END)
+                        # A writer stopped mid-line; end that line so it does not swallow ours
+                        lead = b'' if f.read(1) == b'\n' else b'\r\n' if header.endswith(b'\r\n') else b'\n'
+                writes[kind] = (lead, entries, {'first': total - len(entries), 'count': len(entries),
+                                                'size': size, 'start': size + len(lead)})
+
+            if writes:
+                state['pending'] = {kind: intent for kind, (_, _, intent) in writes.items()}
+                save_state(path, state)
+                for kind, (lead, entries, _) in writes.items():
+                    with open(views[kind], 'ab') as f:
+                        f.write(lead + b''.join(entries))
+                        f.flush()
+                        os.fsync(f.fileno())
+                        state['sizes'][kind] = f.tell()
+
+            if writes or pending or since is None or batch:
+                state.pop('pending', None)
+                state.update(records=total, journal=journal_id, offset=journal_offset)
+                save_state(path, state)
+        return total - min(done, total)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bring the TXT and CSV attendance logs up to date with the journal')
+    parser.add_argument('--logs-dir', help='folder holding the logs (default: the project logs folder)')
+    parser.add_argument('--period', help='period to refresh, such as 2026-10 (default: the current one)')
+    parser.add_argument('--json', action='store_true', help='also rewrite the JSON log of the period')
+    parser.add_argument('--repair-csv', metavar='PATH',
+                        help='only put the missing header line back on a CSV log, such as the old attendance_log.csv')
+    args = parser.parse_args(argv)
+
+    if args.repair_csv:
+        if repair_csv(args.repair_csv):
+            print(f"Added the header line to {args.repair_csv}")
+        else:
+            print(f"{args.repair_csv} already has its header line")
+        return 0
+
+    logs_dir = args.logs_dir or default_logs_dir()
+    period = args.period or current_period()
+    print(f"Added {refresh_views(logs_dir, period)} records to the TXT and CSV logs")
+    if args.json:
+        output = os.path.join(logs_dir, segment_name(JSON_NAME, period))
+        export_json(AttendanceJournal(logs_dir, period=period).records(), output)
+        print(f"Exported to {output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
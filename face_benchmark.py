@@ -0,0 +1,257 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import face_recognition
+import face_index
+from face_gallery import FaceGallery
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far (ru_maxrss is KB on Linux, bytes on macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0), 1)
+
+def summarize(samples):
+    """Latency summary in milliseconds"""
+    samples = np.asarray(samples) * 1000.0
+    return {
+        'runs': len(samples),
+        'mean_ms': round(float(samples.mean()), 3),
+        'p50_ms': round(float(np.percentile(samples, 50)), 3),
+        'p95_ms': round(float(np.percentile(samples, 95)), 3),
+        'min_ms': round(float(samples.min()), 3)
+    }
+
+def measure(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+def random_encodings(count, rng, dim=128):
+    """Unit-length float32 vectors, the same scale as dlib descriptors"""
+    encodings = rng.standard_normal((count, dim), dtype=np.float32)
+    encodings /= np.linalg.norm(encodings, axis=1, keepdims=True)
+    return encodings
+
+def synthetic_image(size, rng):
+    """RGB test frame with a face-sized bright oval on a noisy background"""
+    image = rng.integers(0, 64, (size, size, 3), dtype=np.uint8)
+    yy, xx = np.mgrid[:size, :size]
+    oval = ((yy - size / 2.0) / (size * 0.3)) ** 2 + ((xx - size / 2.0) / (size * 0.22)) ** 2 <= 1
+    image[oval] = (200, 160, 140)
+    return image, (int(size * 0.2), int(size * 0.72), int(size * 0.8), int(size * 0.28))
+
+def bench_cold_start(repeat):
+    """Wall time of one-shot CLI processes, the way PHP runs them without a daemon"""
+    env = dict(os.environ, FACE_RECOGNITION_SOCKET='')
+    script = os.path.join(SCRIPT_DIR, 'face_recognition.py')
+    data_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+    json.dump({'encoding1': [0.0] * 128, 'encoding2': [0.1] * 128}, data_file)
+    data_file.close()
+
+    try:
+        commands = {
+            'python_startup': [sys.executable, '-c', 'pass'],
+            'import_module': [sys.executable, '-c', 'import sys; sys.path.insert(0, %r); import face_recognition'
+                              % SCRIPT_DIR],
+            'cli_compare': [sys.executable, script, 'compare', data_file.name]
+        }
+        results = {}
+        for name, command in commands.items():
+            results[name] = measure(lambda: subprocess.run(command, env=env, stdout=subprocess.DEVNULL,
+                                                           stderr=subprocess.DEVNULL, check=True),
+                                    repeat, warmup=0)
+        return results
+    finally:
+        os.remove(data_file.name)
+
+def bench_encode(image_size, repeat, rng):
+    """Per-image detection and encoding latency on a synthetic frame"""
+    started = time.perf_counter()
+    face_lib = face_recognition.get_face_library()
+    load_seconds = time.perf_counter() - started
+
+    image, box = synthetic_image(image_size, rng)
+    options = face_recognition.encode_options()
+    return {
+        'image_size': image_size,
+        'library_load_ms': round(load_seconds * 1000.0, 3),
+        'detect': measure(lambda: face_recognition.detect_faces(image, options), repeat),
+        # Encoding with a known box times landmarks and the descriptor network even without a real face
+        'encode_known_box': measure(lambda: face_lib.face_encodings(
+            image, known_face_locations=[box], num_jitters=options['num_jitters'],
+            model=options['landmark_model']), repeat),
+        'encode_face': measure(lambda: face_recognition.encode_face(image, options), repeat)
+    }
+
+def bench_compare(repeat, rng):
+    encoding1, encoding2 = random_encodings(2, rng).tolist()
+    request = {'encoding1': encoding1, 'encoding2': encoding2}
+    return measure(lambda: face_recognition.compare_data(request), repeat)
+
+def build_gallery(path, size, rng, chunk=100000):
+    gallery = FaceGallery.create(path)
+    for start in range(0, size, chunk):
+        count = min(chunk, size - start)
+        gallery.append(random_encodings(count, rng), ['emp%d' % i for i in range(start, start + count)])
+    return gallery
+
+def bench_identify(size, probes, repeat, rng, workdir, modes):
+    """1:N identify latency and throughput against a freshly built gallery file"""
+    path = os.path.join(workdir, 'bench_%d.fgal' % size)
+    started = time.perf_counter()
+    gallery = build_gallery(path, size, rng)
+    result = {'gallery_size': size, 'probes': probes,
+              'build_ms': round((time.perf_counter() - started) * 1000.0, 3)}
+
+    # Probes near existing rows, so every search has a real nearest neighbour
+    rows = rng.choice(size, probes, replace=False)
+    probe_rows = np.asarray(gallery.encodings[np.sort(rows)]) + 0.01 * random_encodings(probes, rng)
+    base_request = {'gallery_path': path, 'probes': probe_rows.tolist(), 'top_k': 1}
+
+    face_recognition._galleries.pop(path, None)
+    started = time.perf_counter()
+    face_recognition.load_gallery(path)
+    result['open_ms'] = round((time.perf_counter() - started) * 1000.0, 3)
+
+    requests = {
+        'exact': dict(base_request, exact=True),
+        'float16': dict(base_request, quantize='float16'),
+        'int8': dict(base_request, quantize='int8'),
+        'ann': dict(base_request)
+    }
+    for mode in modes:
+        if mode == 'ann':
+            if size < face_index.ANN_THRESHOLD:
+                continue
+            started = time.perf_counter()
+            face_recognition.load_index(face_recognition.load_gallery(path))
+            result['ann_index_ms'] = round((time.perf_counter() - started) * 1000.0, 3)
+
+        request = requests[mode]
+        response = json.loads(face_recognition.identify_data(request))
+        if not response['success']:
+            result[mode] = {'error': response['error']}
+            continue
+        timing = measure(lambda: face_recognition.identify_data(request), repeat)
+        timing['probes_per_second'] = round(probes / (timing['mean_ms'] / 1000.0), 1)
+        result[mode] = timing
+    result['peak_rss_mb'] = peak_rss_mb()
+
+    face_recognition._galleries.pop(path, None)
+    face_recognition._indexes.pop(path, None)
+    for suffix in ('', '.ids', '.rows', '.lock', '.ivf.npz'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    return result
+
+def run_stage(results, name, fn):
+    """Run one benchmark stage, recording an error instead of aborting the whole run"""
+    print(f"Running {name}...", file=sys.stderr, flush=True)
+    try:
+        results[name] = fn()
+    except Exception as e:
+        results[name] = {'error': str(e)}
+
+def compare_runs(current, baseline):
+    """Relative change of every mean latency that exists in both runs"""
+    changes = {}
+
+    def walk(now, before, prefix):
+        for key, value in now.items():
+            if isinstance(value, dict) and isinstance(before.get(key), dict):
+                walk(value, before[key], prefix + key + '.')
+            elif isinstance(value, list) and isinstance(before.get(key), list):
+                # identify runs are matched up by gallery size
+                earlier = {run.get('gallery_size'): run for run in before[key]}
+                for run in value:
+                    if run.get('gallery_size') in earlier:
+                        walk(run, earlier[run['gallery_size']], '%s%s.%s.' % (prefix, key, run['gallery_size']))
+            elif key == 'mean_ms' and before.get(key):
+                changes[prefix.rstrip('.')] = round(value / before[key] - 1.0, 4)
+
+    walk(current, baseline, '')
+    return changes
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the encode, compare and identify hot paths')
+    parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                        help='comma separated gallery sizes for identify')
+    parser.add_argument('--probes', type=int, default=64, help='probe encodings per identify call')
+    parser.add_argument('--repeat', type=int, default=20, help='timed runs per measurement')
+    parser.add_argument('--image-size', type=int, default=640, help='side of the synthetic test image')
+    parser.add_argument('--modes', default='exact,float16,int8,ann',
+                        help='identify search paths to time (exact, float16, int8, ann)')
+    parser.add_argument('--skip', default='', help='comma separated stages to skip (cold_start, encode, compare)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='directory for the temporary galleries (default: a temp dir)')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--baseline', help='earlier results file to report relative changes against')
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    skip = set(filter(None, args.skip.split(',')))
+    modes = [m for m in args.modes.split(',') if m]
+    workdir = args.workdir or tempfile.mkdtemp(prefix='face_benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+
+    results = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': vars(args)
+        }
+    }
+    try:
+        if 'cold_start' not in skip:
+            run_stage(results, 'cold_start', lambda: bench_cold_start(max(1, args.repeat // 4)))
+        if 'encode' not in skip:
+            run_stage(results, 'encode', lambda: bench_encode(args.image_size, args.repeat, rng))
+        if 'compare' not in skip:
+            run_stage(results, 'compare', lambda: bench_compare(args.repeat * 10, rng))
+
+        results['identify'] = []
+        for size in [int(s) for s in args.sizes.split(',') if s]:
+            stage = {}
+            run_stage(stage, f'identify {size}', lambda: bench_identify(size, min(args.probes, size), args.repeat,
+                                                                        rng, workdir, modes))
+            results['identify'].append(stage[f'identify {size}'])
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results['peak_rss_mb'] = peak_rss_mb()
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['change_vs_baseline'] = compare_runs(results, json.load(f))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+def frame_hash(image, hash_size=8):
+    """Difference hash (64 bits by default) of an RGB image; near-identical frames differ in few bits"""
+    import cv2
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def face_hashes(image, boxes):
+    """frame_hash() of each (top, right, bottom, left) face crop
+
+    A kiosk camera sees the same background all day, so a hash of the
+    whole frame barely changes with who stands in front of it; the crops
+    do.
+    """
+    return tuple(frame_hash(image[top:bottom, left:right]) for top, right, bottom, left in boxes)
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+class RecognitionCache:
+    """LRU cache of recognition results keyed by perceptual hashes of the detected faces
+
+    Entries are grouped by a context (gallery, its size, settings, and an
+    optional client/track id), so a new enrolment or a different kiosk
+    never reuses a stale answer. A lookup hits when a cached frame of the
+    same context has as many faces, each within max_distance bits, and
+    is younger than ttl seconds.
+    """
+
+    def __init__(self, max_entries=256, ttl=5.0, max_distance=6):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, image, boxes, context):
+        return (context, face_hashes(image, boxes))
+
+    def matches(self, hashes, cached_hashes):
+        return len(hashes) == len(cached_hashes) and \
+            all(hamming_distance(a, b) <= self.max_distance for a, b in zip(hashes, cached_hashes))
+
+    def get(self, key):
+        context, hashes = key
+        now = time.time()
+        with self._lock:
+            for cached_key in list(self.entries):
+                stored_at, result = self.entries[cached_key]
+                if now - stored_at > self.ttl:
+                    del self.entries[cached_key]
+                    continue
+                if cached_key[0] == context and self.matches(hashes, cached_key[1]):
+                    self.entries.move_to_end(cached_key)
+                    self.hits += 1
+                    return result
+            self.misses += 1
+            return None
+
+    def put(self, key, result):
+        with self._lock:
+            self.entries[key] = (time.time(), result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / float(lookups) if lookups else 0.0
+            }
@@ -0,0 +1,764 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+GALLERY_MAGIC = b'FGAL'
+GALLERY_VERSION = 2
+ENCODING_SIZE = 128
+
+# magic, version, dimensions, row count, committed size of the .ids sidecar, generation, epoch
+HEADER_FORMAT = '<4sIIQQIQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# Version 1 files have no epoch; they were never compacted, so their epoch is 0
+V1_HEADER_FORMAT = '<4sIIQQI'
+V1_HEADER_SIZE = struct.calcsize(V1_HEADER_FORMAT)
+COUNT_OFFSET = 12
+
+# One .rows sidecar record per row: where its .ids line starts, a hash of its id and its squared norm
+ROW_DTYPE = np.dtype([('offset', '<u8'), ('id_hash', '<u8'), ('sq_norm', '<f4')])
+# How json.dumps() starts a delete line of the change feed; quotes inside values are always escaped
+DELETE_PREFIX = b'{"op": "delete"'
+
+QUANTIZED_DTYPES = {'float16': np.float16, 'int8': np.int8}
+# dlib descriptors have unit length, so single components stay well inside +-0.5
+INT8_RANGE = 0.5
+# Rows of codes widened to float32 at a time; small enough to stay in the CPU cache
+QUANTIZED_CHUNK_ROWS = 4096
+
+class GalleryError(Exception):
+    pass
+
+def new_epoch():
+    """Random id of a newly written gallery file; fits the int64 an IVF index stores it in"""
+    return int.from_bytes(os.urandom(8), 'little') >> 1
+
+def id_hash(identity):
+    """64-bit hash of a row id; ids are compared for real wherever a collision would matter"""
+    digest = hashlib.blake2b(json.dumps(identity).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+def feed_rows(data, start):
+    """(offsets, id hashes) of the enrol lines in a chunk of the change feed that begins at byte start"""
+    offsets, hashes = [], []
+    position = start
+    for line in data.splitlines(keepends=True):
+        if not line.startswith(DELETE_PREFIX):
+            offsets.append(position)
+            hashes.append(id_hash(json.loads(line)['id']))
+        position += len(line)
+    return offsets, hashes
+
+def feed_deletes(data, start):
+    """(id, byte position) of every delete line in a chunk of the change feed, without parsing enrol lines"""
+    deletes = []
+    at = 0 if data.startswith(DELETE_PREFIX) else data.find(b'\n' + DELETE_PREFIX)
+    while at != -1:
+        if data[at:at + 1] == b'\n':
+            at += 1
+        end = data.find(b'\n', at)
+        end = len(data) if end == -1 else end
+        deletes.append((json.loads(data[at:end])['id'], start + at))
+        at = data.find(b'\n' + DELETE_PREFIX, end)
+    return deletes
+
+def gallery_distances(probes, gallery, gallery_sq_norms=None):
+    """Euclidean distances from every probe row to every gallery row in one BLAS pass"""
+    probes = np.ascontiguousarray(probes, dtype=np.float32)
+    gallery = np.ascontiguousarray(gallery, dtype=np.float32)
+    if gallery_sq_norms is None:
+        gallery_sq_norms = np.einsum('ij,ij->i', gallery, gallery)
+
+    # ||a - b||^2 = ||a||^2 + ||b||^2 - 2ab
+    distances = probes @ gallery.T
+    distances *= -2.0
+    distances += np.einsum('ij,ij->i', probes, probes)[:, None]
+    distances += gallery_sq_norms[None, :]
+    np.maximum(distances, 0.0, out=distances)
+    return np.sqrt(distances, out=distances)
+
+def top_k_indices(distances, k):
+    """Column indices of the k smallest distances in each row, nearest first"""
+    k = min(k, distances.shape[1])
+    if k <= 0:
+        return np.empty((distances.shape[0], 0), dtype=np.intp)
+
+    nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    order = np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1)
+    return np.take_along_axis(nearest, order, axis=1)
+
+class GrowableArray:
+    """NumPy buffer with spare capacity
+
+    Appends are amortized O(1), and views handed out before the buffer
+    grows keep pointing at the old, still valid data.
+    """
+
+    def __init__(self, dtype, row_shape=()):
+        self.data = np.zeros((16,) + tuple(row_shape), dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.data.dtype)
+        needed = self.size + len(values)
+        if needed > len(self.data):
+            grown = np.zeros((max(needed, 2 * len(self.data)),) + self.data.shape[1:], dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:needed] = values
+        self.size = needed
+
+    def view(self):
+        return self.data[:self.size]
+
+def close_pairs(a, b=None, tolerance=0.6, block_rows=2048, alive_a=None, alive_b=None):
+    """Yield (row_a, row_b, distance) for every pair of rows within tolerance
+
+    Distances are computed one block_rows x block_rows tile at a time,
+    so memory stays bounded however many rows a and b have. Without b,
+    a is compared with itself and every unordered pair is reported once.
+    Pairs picked by the float32 pass are re-checked exactly, with a
+    small margin so none near the threshold are lost to rounding.
+    """
+    same = b is None
+    if same:
+        b, alive_b = a, alive_a
+    b_sq_norms = np.empty(len(b), dtype=np.float32)
+    for start in range(0, len(b), block_rows):
+        block = np.asarray(b[start:start + block_rows], dtype=np.float32)
+        b_sq_norms[start:start + len(block)] = np.einsum('ij,ij->i', block, block)
+
+    for a_start in range(0, len(a), block_rows):
+        block_a = np.asarray(a[a_start:a_start + block_rows], dtype=np.float32)
+        for b_start in range(a_start if same else 0, len(b), block_rows):
+            block_b = np.asarray(b[b_start:b_start + block_rows], dtype=np.float32)
+            close = gallery_distances(block_a, block_b, b_sq_norms[b_start:b_start + len(block_b)])
+            close = close <= tolerance + 1e-3
+            if same and a_start == b_start:
+                close = np.triu(close, k=1)
+            if alive_a is not None:
+                close &= alive_a[a_start:a_start + len(block_a), None]
+            if alive_b is not None:
+                close &= alive_b[None, b_start:b_start + len(block_b)]
+
+            rows, cols = np.nonzero(close)
+            if len(rows) == 0:
+                continue
+            exact = np.linalg.norm(block_a[rows].astype(np.float64) - block_b[cols], axis=1)
+            for row, col, distance in zip(rows, cols, exact):
+                if distance <= tolerance:
+                    yield a_start + int(row), b_start + int(col), float(distance)
+
+def widen_float16(codes):
+    """float32 array whose values are float16 codes times 2**112, without a slow float16 conversion
+
+    Moving the sign, exponent and mantissa bits of a float16 into a
+    float32 leaves the value short of the exponent bias difference,
+    which the caller folds into its own scale.
+    """
+    bits = codes.view(np.uint16).astype(np.uint32)
+    magnitude = bits & 0x7fff
+    magnitude <<= 13
+    bits &= 0x8000
+    bits <<= 16
+    bits |= magnitude
+    return bits.view(np.float32)
+
+FLOAT16_WIDEN_SCALE = 2.0 ** 112
+
+def search_quantized(probes, codes, code_sq_norms, scale, encodings, k, rerank=32, alive=None):
+    """Top-k rows per probe as (distances, rows) lists, nearest first
+
+    A coarse pass scores the compact codes on ||b||^2 - 2ab, with the
+    code scale folded into the probes, so rows are widened chunk by chunk
+    but never decoded and no distance is finished. The `rerank` best rows
+    per probe are picked once over the whole gallery and re-ranked with
+    exact float32 distances on the stored encodings.
+    """
+    probes = np.ascontiguousarray(probes, dtype=np.float32)
+    keep = min(len(codes), max(k, rerank))
+    if codes.dtype == np.float16:
+        scale *= FLOAT16_WIDEN_SCALE
+    # ||a - b||^2 ranks rows like ||b||^2 - 2ab, since ||a||^2 is the same for every row
+    weighted = probes * np.float32(-2.0 * scale)
+
+    scores = np.empty((len(probes), len(codes)), dtype=np.float32)
+    for start in range(0, len(codes), QUANTIZED_CHUNK_ROWS):
+        chunk = codes[start:start + QUANTIZED_CHUNK_ROWS]
+        chunk = widen_float16(chunk) if chunk.dtype == np.float16 else chunk.astype(np.float32)
+        np.matmul(weighted, chunk.T, out=scores[:, start:start + len(chunk)])
+    scores += code_sq_norms[None, :]
+    if alive is not None:
+        scores[:, ~alive] = np.inf
+
+    best_rows = top_k_indices(scores, keep)
+    best_scores = np.take_along_axis(scores, best_rows, axis=1)
+
+    all_distances, all_rows = [], []
+    for probe, coarse, rows in zip(probes, best_scores, best_rows):
+        rows = np.sort(rows[np.isfinite(coarse)])
+        distances = gallery_distances(probe[None, :], encodings[rows])
+        nearest = top_k_indices(distances, k)[0]
+        all_distances.append(distances[0, nearest])
+        all_rows.append(rows[nearest])
+    return all_distances, all_rows
+
+class QuantizedCodes:
+    """Compact copy of the gallery rows for the coarse distance pass
+
+    float16 halves and int8 quarters the bytes a scan has to stream,
+    though numpy has no fast float16 arithmetic, so only int8 keeps up
+    with a float32 scan.
+    int8 uses one fixed scale, so rows appended later never force the
+    existing codes to be re-encoded; components outside INT8_RANGE are
+    clipped, which only affects the coarse ranking.
+    """
+
+    def __init__(self, dtype, dim):
+        if dtype not in QUANTIZED_DTYPES:
+            raise GalleryError(f"Unsupported quantization {dtype}, use one of {', '.join(QUANTIZED_DTYPES)}")
+        self.dtype = dtype
+        self.scale = INT8_RANGE / 127.0 if dtype == 'int8' else 1.0
+        self.codes = GrowableArray(QUANTIZED_DTYPES[dtype], (dim,))
+        self.sq_norms = GrowableArray(np.float32)
+
+    def encode(self, encodings):
+        encodings = np.asarray(encodings, dtype=np.float32)
+        if self.dtype == 'int8':
+            return np.clip(np.rint(encodings / self.scale), -127, 127).astype(np.int8)
+        return encodings.astype(np.float16)
+
+    def add(self, encodings):
+        for start in range(0, len(encodings), QUANTIZED_CHUNK_ROWS):
+            codes = self.encode(encodings[start:start + QUANTIZED_CHUNK_ROWS])
+            # Coarse distances use the norms of what the codes decode to
+            decoded = codes.astype(np.float32) * self.scale
+            self.codes.extend(codes)
+            self.sq_norms.extend(np.einsum('ij,ij->i', decoded, decoded))
+
+    def view(self):
+        return self.codes.view(), self.sq_norms.view(), self.scale
+
+class TemplateIndex:
+    """Gallery rows grouped per identity, with a running centroid for each identity
+
+    Rows are folded in and removed incrementally, so picking up a change
+    only costs the rows involved. Row lists are replaced rather than
+    mutated, so a search that already holds one is not disturbed.
+    """
+
+    def __init__(self, dim):
+        self.identities = []
+        self.rows = []
+        self.positions = {}
+        self.sums = GrowableArray(np.float64, (dim,))
+        self.counts = GrowableArray(np.int64)
+        self._centroids = GrowableArray(np.float32, (dim,))
+        self.live_rows = 0
+
+    def add(self, ids, encodings, rows):
+        """Fold in the given rows"""
+        if len(rows) == 0:
+            return
+
+        owners = np.empty(len(rows), dtype=np.int64)
+        for i, row in enumerate(rows):
+            identity = ids[row]
+            position = self.positions.get(identity)
+            if position is None:
+                position = self.positions[identity] = len(self.identities)
+                self.identities.append(identity)
+                self.rows.append([])
+            self.rows[position] = self.rows[position] + [int(row)]
+            owners[i] = position
+
+        grow = len(self.identities) - self.counts.size
+        if grow:
+            self.sums.extend(np.zeros((grow, self.sums.data.shape[1])))
+            self.counts.extend(np.zeros(grow))
+            self._centroids.extend(np.zeros((grow, self._centroids.data.shape[1])))
+        np.add.at(self.sums.data, owners, np.asarray(encodings[np.asarray(rows)], dtype=np.float64))
+        np.add.at(self.counts.data, owners, 1)
+        self.live_rows += len(rows)
+        self._update_centroids(np.unique(owners))
+
+    def remove(self, ids, encodings, rows):
+        """Take deleted rows out of their identities"""
+        touched = set()
+        for row in rows:
+            position = self.positions[ids[row]]
+            self.rows[position] = [r for r in self.rows[position] if r != row]
+            self.sums.data[position] -= encodings[row]
+            self.counts.data[position] -= 1
+            touched.add(position)
+        self.live_rows -= len(rows)
+        self._update_centroids(np.array(sorted(touched), dtype=np.int64))
+
+    def _update_centroids(self, positions):
+        if len(positions) == 0:
+            return
+        counts = self.counts.data[positions]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            centroids = self.sums.data[positions] / counts[:, None]
+        # Identities whose every template was deleted are parked far away from every probe
+        centroids[counts == 0] = 1e4
+        self._centroids.data[positions] = centroids
+
+    @property
+    def centroids(self):
+        """(identities, dim) float32 matrix of per-identity mean encodings"""
+        return self._centroids.view()
+
+    def has_multiple_templates(self):
+        # Identities whose templates were all deleted keep their position but no longer count
+        return np.count_nonzero(self.counts.view()) < self.live_rows
+
+class FeedEntries:
+    """Change-feed entries of the gallery rows, parsed only when asked for
+
+    Where each row's line starts comes from the .rows sidecar, so opening
+    a gallery parses no lines and a search decodes only the rows it
+    returns. The feed stays open, so rows keep resolving against the file
+    their offsets refer to after compact() replaced it.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._lock = threading.Lock()
+        self.offsets = np.empty(0, dtype=np.uint64)
+
+    def line(self, row):
+        with self._lock:
+            self._file.seek(int(self.offsets[row]))
+            return self._file.readline()
+
+class FeedField:
+    """Read-only sequence of one field (id, name or settings) of every row"""
+
+    def __init__(self, entries, name):
+        self._entries = entries
+        self._name = name
+
+    def __getitem__(self, row):
+        return json.loads(self._entries.line(row)).get(self._name)
+
+    def __len__(self):
+        return len(self._entries.offsets)
+
+class GallerySnapshot:
+    """Consistent view of a gallery for one search
+
+    A background refresh can pick up new rows while a search is running;
+    the snapshot keeps the row count, encodings and ids it started with.
+    """
+
+    def __init__(self, gallery):
+        self.path = gallery.path
+        self.count = gallery.count
+        self.encodings = gallery.encodings
+        self.ids = gallery.ids
+        self.settings = gallery.settings
+        self.sq_norms = gallery.sq_norms.view()
+        self.alive = gallery.alive.view()
+        self.has_deletions = gallery.deleted_count > 0
+        self.generation = gallery.generation
+        self.epoch = gallery.epoch
+        self.templates = gallery.templates
+        self._gallery = gallery
+        self._quantized = {dtype: codes.view() for dtype, codes in gallery._quantized.items()}
+
+    def quantized(self, dtype):
+        """(codes, squared norms, scale) of the rows this snapshot covers"""
+        if dtype not in self._quantized:
+            with self._gallery._lock:
+                if self._gallery.epoch != self.epoch:
+                    raise GalleryError('Gallery was compacted during the search, retry')
+                self._quantized[dtype] = self._gallery.quantized(dtype).view()
+        codes, sq_norms, scale = self._quantized[dtype]
+        return codes[:self.count], sq_norms[:self.count], scale
+
+    def __len__(self):
+        return self.count
+
+class FaceGallery:
+    """Binary gallery of float32 face encodings with a JSON-lines change feed
+
+    The encodings file is a fixed header followed by `count` rows of
+    `dim` float32 values, so it can be memory-mapped without parsing.
+    The .ids sidecar is a change feed: one line per enrolled row (id,
+    name and encode settings) plus delete lines that tombstone every row
+    of an id. The fixed-width .rows sidecar holds, per row, where its
+    line starts, a hash of its id and its squared norm, so opening a
+    gallery parses no JSON and reads no encodings; ids are resolved for
+    the rows a search returns. Changes are written first and the header
+    counts and generation are updated last, which keeps a half-written
+    change invisible; compact() rewrites the files without the
+    tombstoned rows and gives the new file a random epoch, so anything
+    that holds row numbers can tell they changed. Version 1 files have
+    no .rows sidecar and parse their feed until compact() upgrades them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + '.ids'
+        self.rows_path = path + '.rows'
+        self.lock_path = path + '.lock'
+        self.dim = ENCODING_SIZE
+        self.header_size = HEADER_SIZE
+        self._reset()
+        self._lock = threading.RLock()
+
+    def _reset(self):
+        self.count = 0
+        self.index_size = 0
+        self.generation = None
+        self.epoch = None
+        self._entries = None
+        self.ids = self.names = self.settings = []
+        self._table = np.empty(0, dtype=ROW_DTYPE)
+        self.sq_norms = GrowableArray(np.float32)
+        self.alive = GrowableArray(np.bool_)
+        self.deleted_count = 0
+        self._matrix = None
+        self._templates = None
+        self._quantized = {}
+
+    @classmethod
+    def create(cls, path, dim=ENCODING_SIZE):
+        """Create an empty gallery, replacing any existing one at path"""
+        with open(path, 'wb') as f:
+            f.write(struct.pack(HEADER_FORMAT, GALLERY_MAGIC, GALLERY_VERSION, dim, 0, 0, 0, new_epoch()))
+        open(path + '.ids', 'w').close()
+        open(path + '.rows', 'w').close()
+        return cls.open(path)
+
+    @classmethod
+    def open(cls, path, create=False, dim=ENCODING_SIZE):
+        """Open an existing gallery, optionally creating it if it does not exist"""
+        if create and not os.path.exists(path):
+            return cls.create(path, dim)
+
+        gallery = cls(path)
+        gallery.refresh(force=True)
+        return gallery
+
+    def _file_lock(self, exclusive):
+        """Lock file shared by every process using this gallery"""
+        f = open(self.lock_path, 'a+b')
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        return f
+
+    def _read_header(self):
+        """(dim, count, index_size, generation, epoch, header size) from the gallery file header"""
+        with open(self.path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        if len(header) < V1_HEADER_SIZE:
+            raise GalleryError(f"Truncated gallery header in {self.path}")
+
+        magic, version = struct.unpack('<4sI', header[:8])
+        if magic != GALLERY_MAGIC:
+            raise GalleryError(f"{self.path} is not a face gallery file")
+        if version == 1:
+            _, _, dim, count, index_size, generation = struct.unpack(V1_HEADER_FORMAT, header[:V1_HEADER_SIZE])
+            return dim, count, index_size, generation, 0, V1_HEADER_SIZE
+        if version != GALLERY_VERSION:
+            raise GalleryError(f"Unsupported gallery version {version} in {self.path}")
+        if len(header) != HEADER_SIZE:
+            raise GalleryError(f"Truncated gallery header in {self.path}")
+        _, _, dim, count, index_size, generation, epoch = struct.unpack(HEADER_FORMAT, header)
+        return dim, count, index_size, generation, epoch, HEADER_SIZE
+
+    def refresh(self, force=False):
+        """Apply changes made since the last refresh, possibly by another process
+
+        Only a header read is needed when nothing changed. Otherwise only
+        the new change-feed lines and new rows are processed, unless the
+        file was compacted, which forces a full reload.
+        Returns True if anything changed.
+        """
+        _, _, _, generation, epoch, _ = self._read_header()
+        if not force and generation == self.generation and epoch == self.epoch:
+            return False
+
+        with self._lock, self._file_lock(exclusive=False):
+            self._apply_changes(force)
+        return True
+
+    def _apply_changes(self, force):
+        # Caller holds the gallery lock file
+        with self._lock:
+            dim, count, index_size, generation, epoch, header_size = self._read_header()
+            if force or epoch != self.epoch or index_size < self.index_size:
+                self._reset()
+                self._entries = FeedEntries(self.index_path)
+                self.ids, self.names, self.settings = (FeedField(self._entries, name)
+                                                       for name in ('id', 'name', 'settings'))
+            first_new_row = self.count
+
+            with open(self.index_path, 'rb') as f:
+                f.seek(self.index_size)
+                data = f.read(index_size - self.index_size)
+            encodings = self._map(count, dim, header_size)
+            if header_size == HEADER_SIZE:
+                table = self._row_table(count, index_size, encodings)
+            else:
+                offsets, hashes = feed_rows(data, self.index_size)
+                table = np.concatenate([self._table, self._table_rows(offsets, hashes, encodings[first_new_row:])])
+            if len(table) != count:
+                raise GalleryError(f"Index {self.index_path} does not match {self.path}")
+
+            self.dim = dim
+            self.header_size = header_size
+            self.count = count
+            self.index_size = index_size
+            self.generation = generation
+            self.epoch = epoch
+            self._matrix = encodings
+            self._table = table
+            self._entries.offsets = table['offset']
+
+            new_rows = encodings[first_new_row:count]
+            self.sq_norms.extend(table['sq_norm'][first_new_row:count])
+            self.alive.extend(np.ones(count - first_new_row, dtype=np.bool_))
+            for codes in self._quantized.values():
+                codes.add(new_rows)
+            if self._templates is not None:
+                self._templates.add(self.id_hashes, encodings, np.arange(first_new_row, count))
+
+            # A delete tombstones the rows its id had when the delete was written
+            deletes = feed_deletes(data, index_size - len(data))
+            dead = set()
+            if deletes:
+                # Rows sorted by id hash, so finding the rows of many ids costs a binary search each
+                hashes = np.ascontiguousarray(table['id_hash'])
+                order = np.argsort(hashes, kind='stable')
+                targets = np.array([id_hash(identity) for identity, _ in deletes], dtype=np.uint64)
+                lows = np.searchsorted(hashes[order], targets, 'left')
+                highs = np.searchsorted(hashes[order], targets, 'right')
+                rows_then = np.searchsorted(np.ascontiguousarray(table['offset']),
+                                            [position for _, position in deletes])
+                for (identity, _), low, high, limit in zip(deletes, lows, highs, rows_then):
+                    dead.update(int(row) for row in order[low:high]
+                                if row < limit and self.alive.data[row] and self.ids[row] == identity)
+            dead = sorted(dead)
+            if dead:
+                self.alive.data[dead] = False
+                self.deleted_count += len(dead)
+                if self._templates is not None:
+                    self._templates.remove(self.id_hashes, encodings, dead)
+
+    def _map(self, count, dim, header_size):
+        if count == 0:
+            return np.empty((0, dim), dtype=np.float32)
+        return np.memmap(self.path, dtype=np.float32, mode='r', offset=header_size, shape=(count, dim))
+
+    @staticmethod
+    def _table_rows(offsets, hashes, encodings):
+        table = np.empty(len(offsets), dtype=ROW_DTYPE)
+        table['offset'] = offsets
+        table['id_hash'] = hashes
+        for start in range(0, len(table), QUANTIZED_CHUNK_ROWS):
+            rows = np.asarray(encodings[start:start + QUANTIZED_CHUNK_ROWS])
+            table['sq_norm'][start:start + len(rows)] = np.einsum('ij,ij->i', rows, rows)
+        return table
+
+    def _row_table(self, count, index_size, encodings):
+        """.rows sidecar records of the first count rows, rebuilt from the feed if it falls short"""
+        if count == 0:
+            return np.empty(0, dtype=ROW_DTYPE)
+        if not os.path.exists(self.rows_path) or os.path.getsize(self.rows_path) < count * ROW_DTYPE.itemsize:
+            # A gallery written before the sidecar existed; parse the whole feed once
+            with open(self.index_path, 'rb') as f:
+                offsets, hashes = feed_rows(f.read(index_size), 0)
+            temp = f"{self.rows_path}.{os.getpid()}.tmp"
+            with open(temp, 'wb') as f:
+                f.write(self._table_rows(offsets, hashes, encodings).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.rows_path)
+        return np.memmap(self.rows_path, dtype=ROW_DTYPE, mode='r', shape=(count,))
+
+    def _rows_of(self, identity):
+        """Rows enrolled for an id; only rows whose id hash matches are parsed"""
+        rows = np.flatnonzero(self._table['id_hash'] == np.uint64(id_hash(identity)))
+        return [int(row) for row in rows if self.ids[row] == identity]
+
+    @property
+    def id_hashes(self):
+        return self._table['id_hash']
+
+    @property
+    def encodings(self):
+        """Read-only (count, dim) float32 view of the encodings, memory-mapped"""
+        if self._matrix is None:
+            self._matrix = self._map(self.count, self.dim, self.header_size)
+        return self._matrix
+
+    @property
+    def templates(self):
+        """TemplateIndex of this gallery, kept up to date by refresh()"""
+        with self._lock:
+            if self._templates is None:
+                templates = TemplateIndex(self.dim)
+                # Rows are grouped by id hash, so building this parses no ids
+                templates.add(self.id_hashes, self.encodings, np.flatnonzero(self.alive.view()))
+                self._templates = templates
+            return self._templates
+
+    def quantized(self, dtype):
+        """QuantizedCodes of this gallery, built on first use and kept up to date by refresh()"""
+        with self._lock:
+            if dtype not in self._quantized:
+                codes = QuantizedCodes(dtype, self.dim)
+                codes.add(self.encodings)
+                self._quantized[dtype] = codes
+            return self._quantized[dtype]
+
+    def snapshot(self):
+        with self._lock:
+            return GallerySnapshot(self)
+
+    def __len__(self):
+        return self.count
+
+    def live_count(self):
+        return self.count - self.deleted_count
+
+    def live_ids(self):
+        """Ids that still have at least one enrolled row; parses the feed line of every live row"""
+        return set(self.ids[row] for row in np.flatnonzero(self.alive.view()))
+
+    def row_of(self, identity):
+        """Row number of the first live encoding enrolled for an id, or None"""
+        for row in self._rows_of(identity):
+            if self.alive.data[row]:
+                return row
+        return None
+
+    def get(self, identity):
+        row = self.row_of(identity)
+        return None if row is None else np.array(self.encodings[row])
+
+    def append(self, encodings, ids, names=None, settings=None):
+        """Append encodings to the end of the gallery without rewriting existing rows
+
+        settings is either one dict of encode settings shared by all rows or
+        a list with one entry per row.
+        """
+        encodings = np.ascontiguousarray(encodings, dtype=np.float32).reshape(-1, self.dim)
+        names = names if names is not None else [None] * len(ids)
+        if settings is None or isinstance(settings, dict):
+            settings = [settings] * len(ids)
+        if not len(encodings) == len(ids) == len(names) == len(settings):
+            raise GalleryError('encodings, ids, names and settings must have the same length')
+
+        entries = []
+        for entry_id, name, entry_settings in zip(ids, names, settings):
+            entry = {'id': entry_id, 'name': name}
+            if entry_settings:
+                entry['settings'] = entry_settings
+            entries.append(entry)
+
+        with self._lock, self._file_lock(exclusive=True), open(self.path, 'r+b') as f:
+            # Another writer may have appended since we last looked
+            dim, count, index_size, generation, _, header_size = self._read_header()
+            f.seek(header_size + count * self.dim * 4)
+            f.write(encodings.tobytes())
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+
+            if header_size == HEADER_SIZE:
+                # The new records go after those of the committed rows, which must all be there
+                self._row_table(count, index_size, self._map(count, dim, header_size))
+            index_size, offsets = self._append_index(index_size, entries)
+            if header_size == HEADER_SIZE:
+                table = self._table_rows(offsets, [id_hash(entry_id) for entry_id in ids], encodings)
+                with open(self.rows_path, 'r+b') as rows:
+                    rows.seek(count * ROW_DTYPE.itemsize)
+                    rows.write(table.tobytes())
+                    rows.truncate()
+                    rows.flush()
+                    os.fsync(rows.fileno())
+            self._write_counts(f, count + len(ids), index_size, generation + 1)
+
+        self.refresh()
+        return count
+
+    def delete(self, ids):
+        """Tombstone every row of the given ids; returns the number of rows removed"""
+        before = self.deleted_count
+        with self._lock, self._file_lock(exclusive=True), open(self.path, 'r+b') as f:
+            _, count, index_size, generation, _, _ = self._read_header()
+            index_size, _ = self._append_index(index_size, [{'op': 'delete', 'id': entry_id} for entry_id in ids])
+            self._write_counts(f, count, index_size, generation + 1)
+
+        self.refresh()
+        return self.deleted_count - before
+
+    def compact(self):
+        """Rewrite the gallery without tombstoned rows"""
+        with self._lock, self._file_lock(exclusive=True):
+            self._apply_changes(force=False)
+            live = np.flatnonzero(self.alive.view())
+
+            table = self._table[live]
+            with open(self.index_path + '.tmp', 'wb') as f:
+                # Enrol lines are copied as they are, without parsing them
+                for i, row in enumerate(live):
+                    table['offset'][i] = f.tell()
+                    f.write(self._entries.line(row))
+                index_size = f.tell()
+                f.flush()
+                os.fsync(f.fileno())
+
+            with open(self.rows_path + '.tmp', 'wb') as f:
+                f.write(table.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+            with open(self.path + '.tmp', 'wb') as f:
+                # A new epoch tells readers and saved indexes that row numbers changed
+                f.write(struct.pack(HEADER_FORMAT, GALLERY_MAGIC, GALLERY_VERSION, self.dim,
+                                    len(live), index_size, self.generation + 1, new_epoch()))
+                for start in range(0, len(live), 65536):
+                    f.write(np.ascontiguousarray(self.encodings[live[start:start + 65536]]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+            # Readers hold the shared lock while reloading, so they never see one file without the other.
+            # A .rows sidecar shorter than the old gallery is rebuilt, so it may go first
+            os.replace(self.rows_path + '.tmp', self.rows_path)
+            os.replace(self.index_path + '.tmp', self.index_path)
+            os.replace(self.path + '.tmp', self.path)
+            self._apply_changes(force=True)
+        return len(live)
+
+    def _write_counts(self, f, count, index_size, generation):
+        f.seek(COUNT_OFFSET)
+        f.write(struct.pack('<QQI', count, index_size, generation & 0xFFFFFFFF))
+        f.flush()
+        os.fsync(f.fileno())
+
+    def _append_index(self, index_size, entries):
+        """(new committed size, offset of each entry's line) after writing entries to the change feed"""
+        # Overwrite anything left behind by a change that never updated the header
+        offsets = []
+        with open(self.index_path, 'r+b') as f:
+            f.seek(index_size)
+            for entry in entries:
+                offsets.append(f.tell())
+                f.write((json.dumps(entry) + '\n').encode('utf-8'))
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+            return f.tell(), offsets
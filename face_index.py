@@ -0,0 +1,157 @@
+import os
+
+import numpy as np
+
+from face_gallery import gallery_distances, top_k_indices
+
+# Galleries at least this large are searched through the IVF index by identify
+ANN_THRESHOLD = int(os.environ.get('FACE_ANN_THRESHOLD', 50000))
+DEFAULT_N_PROBE = 8
+# Memory for one chunk of row-to-centroid distances
+CHUNK_BYTES = 64 << 20
+
+def index_path_for(gallery_path):
+    return gallery_path + '.ivf.npz'
+
+def assign_to_centroids(encodings, centroids):
+    """Nearest centroid for every row, computed in chunks to bound memory"""
+    labels = np.empty(len(encodings), dtype=np.int32)
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    chunk_rows = max(1, CHUNK_BYTES // (4 * len(centroids)))
+    for start in range(0, len(encodings), chunk_rows):
+        chunk = encodings[start:start + chunk_rows]
+        labels[start:start + len(chunk)] = np.argmin(
+            gallery_distances(chunk, centroids, centroid_norms), axis=1)
+    return labels
+
+def train_centroids(encodings, n_lists, iterations=10, seed=0):
+    """Plain k-means over a random sample of the gallery"""
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(encodings), max(n_lists * 64, 10000))
+    sample = np.asarray(encodings[np.sort(rng.choice(len(encodings), sample_size, replace=False))],
+                        dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+
+    for _ in range(iterations):
+        labels = assign_to_centroids(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        counts = np.bincount(labels, minlength=n_lists)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # Re-seed empty lists so every list stays useful
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+    return centroids
+
+class IVFIndex:
+    """Inverted-file index over gallery rows
+
+    Rows are grouped by their nearest k-means centroid. A search only
+    scans the `n_probe` lists whose centroids are closest to the probe,
+    so raising n_probe trades latency for recall; n_probe equal to the
+    number of lists is an exact search. Rows appended to the gallery
+    after the index was built are always scanned exhaustively.
+    """
+
+    def __init__(self, centroids, order, offsets, count, epoch=None):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.order = order
+        self.offsets = offsets
+        self.count = count
+        # Identifies the gallery file the row numbers refer to; compaction renumbers rows
+        self.epoch = epoch
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, encodings, n_lists=None, iterations=10, seed=0, epoch=None):
+        count = len(encodings)
+        n_lists = n_lists or max(1, int(4 * np.sqrt(count)))
+        n_lists = min(n_lists, count)
+
+        centroids = train_centroids(encodings, n_lists, iterations, seed)
+        labels = assign_to_centroids(encodings, centroids)
+        order = np.argsort(labels, kind='stable').astype(np.int64)
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=n_lists), out=offsets[1:])
+        return cls(centroids, order, offsets, count, epoch)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            epoch = int(data['epoch']) if 'epoch' in data else None
+            return cls(data['centroids'], data['order'], data['offsets'], int(data['count']), epoch)
+
+    def save(self, path):
+        # np.savez appends .npz unless the name already ends with it
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, centroids=self.centroids, order=self.order, offsets=self.offsets,
+                     count=np.int64(self.count), epoch=np.int64(self.epoch or 0))
+        os.replace(path + '.tmp', path)
+
+    def is_stale(self, total_rows, epoch=None, rebuild_ratio=0.25):
+        """True once the gallery was compacted, shrank or had too many rows appended since the build"""
+        if epoch is not None and self.epoch != epoch:
+            return True
+        return self.count > total_rows or total_rows - self.count > self.count * rebuild_ratio
+
+    def candidates(self, probe, n_probe, total_rows):
+        """Gallery rows stored in the n_probe lists nearest to one probe"""
+        n_probe = min(n_probe, self.n_lists)
+        centroid_distances = gallery_distances(probe[None, :], self.centroids)[0]
+        lists = np.argpartition(centroid_distances, n_probe - 1)[:n_probe]
+
+        parts = [self.order[self.offsets[l]:self.offsets[l + 1]] for l in lists]
+        if total_rows > self.count:
+            parts.append(np.arange(self.count, total_rows, dtype=np.int64))
+        return np.sort(np.concatenate(parts))
+
+    def search(self, probes, encodings, k, n_probe=DEFAULT_N_PROBE, alive=None):
+        """Approximate top-k rows per probe as (distances, rows) lists, nearest first
+
+        alive is an optional boolean mask of rows that have not been deleted.
+        """
+        probes = np.ascontiguousarray(probes, dtype=np.float32)
+        all_distances, all_rows = [], []
+        for probe in probes:
+            rows = self.candidates(probe, n_probe, len(encodings))
+            if alive is not None:
+                rows = rows[alive[rows]]
+            distances = gallery_distances(probe[None, :], encodings[rows])
+            nearest = top_k_indices(distances, k)[0]
+            all_distances.append(distances[0, nearest])
+            all_rows.append(rows[nearest])
+        return all_distances, all_rows
+
+def load_or_build_index(gallery, rebuild_ratio=0.25):
+    """Load the index stored next to a gallery, rebuilding it once it no longer fits the gallery
+
+    gallery may also be a GallerySnapshot, so the index matches the rows a search will see.
+    """
+    path = index_path_for(gallery.path)
+    index = None
+    if os.path.exists(path):
+        index = IVFIndex.load(path)
+        if index.is_stale(len(gallery), gallery.epoch, rebuild_ratio):
+            index = None
+
+    if index is None:
+        index = IVFIndex.build(gallery.encodings, epoch=gallery.epoch)
+        index.save(path)
+    return index
+
+def measure_recall(index, encodings, k=10, n_probe=DEFAULT_N_PROBE, samples=200, seed=0):
+    """Share of exact top-k rows the index also returns, using gallery rows as probes"""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(encodings), min(samples, len(encodings)), replace=False)
+    probes = np.asarray(encodings[np.sort(rows)], dtype=np.float32)
+
+    exact = np.concatenate([top_k_indices(gallery_distances(probes[i:i + 16], encodings), k)
+                            for i in range(0, len(probes), 16)])
+    _, approximate = index.search(probes, encodings, k, n_probe)
+    hits = sum(len(set(e) & set(a)) for e, a in zip(exact, approximate))
+    return hits / float(exact.size)
@@ -1,23 +1,46 @@
 <?php
 class FaceRecognition {
     private $pythonScript;
-    
+    private $daemonSocket;
+
     public function __construct() {
         $this->pythonScript = __DIR__ . '/face_recognition.py';
+        // Socket of face_server.py; when it is running, requests skip the python3 start-up cost
+        $this->daemonSocket = getenv('FACE_RECOGNITION_SOCKET') ?: sys_get_temp_dir() . '/face_recognition.sock';
     }
-    
-    public function extractFaceEncoding($imagePath) {
+
+    public function extractFaceEncoding($imagePath, $options = []) {
+        // $options may set detection_model, upsample, num_jitters, landmark_model, max_size, detect_size and all_faces
+        $result = $this->sendToDaemon([
+            'command' => 'encode',
+            'image_path' => realpath($imagePath) ?: $imagePath
+        ] + $options);
+        if($result !== false) {
+            return $result;
+        }
+
         // Call Python script for face encoding (requires face_recognition library)
-        $command = "python3 {$this->pythonScript} encode " . escapeshellarg($imagePath);
+        $command = "python3 {$this->pythonScript} encode " . escapeshellarg($imagePath) . $this->encodeFlags($options);
         $output = shell_exec($command);
-        
+
         if($output) {
             return json_decode(trim($output), true);
         }
-        
+
         return false;
     }
-    
+
+    public function extractFaceEncodingFromData($imageData, $options = []) {
+        // $imageData is a base64 data URL such as the kiosk's canvas.toDataURL() frames
+        $result = $this->sendToDaemon(['command' => 'encode', 'image' => $imageData] + $options);
+        if($result !== false) {
+            return $result;
+        }
+
+        $command = "python3 {$this->pythonScript} encode -" . $this->encodeFlags($options);
+        return $this->runWithInput($command, $imageData);
+    }
+
     public function compareFaces($encoding1, $encoding2, $tolerance = 0.6) {
         // Compare two face encodings
         $data = [
@@ -25,19 +48,148 @@ class FaceRecognition {
             'encoding2' => $encoding2,
             'tolerance' => $tolerance
         ];
-        
-        $tempFile = tempnam(sys_get_temp_dir(), 'face_compare');
-        file_put_contents($tempFile, json_encode($data));
-        
-        $command = "python3 {$this->pythonScript} compare " . escapeshellarg($tempFile);
-        $output = shell_exec($command);
-        
-        unlink($tempFile);
-        
+
+        return $this->runDataCommand('compare', $data);
+    }
+
+    public function identifyFaces($probeEncodings, $galleryEncodings, $ids = null, $topK = 1, $tolerance = 0.6) {
+        // Match one or more probe encodings against the whole gallery in a single call
+        $data = [
+            'probes' => $probeEncodings,
+            'gallery' => $galleryEncodings,
+            'ids' => $ids,
+            'top_k' => $topK,
+            'tolerance' => $tolerance
+        ];
+
+        return $this->runDataCommand('identify', $data);
+    }
+
+    public function identifyInGallery($probeEncodings, $galleryPath, $topK = 1, $tolerance = 0.6) {
+        // Match against a binary gallery file instead of sending every encoding along
+        return $this->runDataCommand('identify', [
+            'probes' => $probeEncodings,
+            'gallery_path' => $galleryPath,
+            'top_k' => $topK,
+            'tolerance' => $tolerance
+        ]);
+    }
+
+    public function identifyImageInGallery($imageData, $galleryPath, $topK = 1, $tolerance = 0.6, $allFaces = false) {
+        // Encode a base64 frame and match it against a gallery file in one request.
+        // With $allFaces every face in the frame gets its own result, box and detector score.
+        return $this->runDataCommand('identify', [
+            'image' => $imageData,
+            'gallery_path' => $galleryPath,
+            'top_k' => $topK,
+            'tolerance' => $tolerance,
+            'all_faces' => $allFaces
+        ]);
+    }
+
+    public function enrollFace($galleryPath, $employeeId, $encoding, $name = null) {
+        // Append one encoding to a binary gallery file, creating it if needed
+        return $this->runDataCommand('enroll', [
+            'gallery_path' => $galleryPath,
+            'id' => $employeeId,
+            'name' => $name,
+            'encoding' => $encoding
+        ]);
+    }
+
+    public function findDuplicateFaces($galleryPath, $tolerance = 0.4, $maxPairs = 1000) {
+        // Pairs of different employees whose enrolled faces are closer than the tolerance
+        return $this->runDataCommand('compare-matrix', [
+            'gallery_path' => $galleryPath,
+            'tolerance' => $tolerance,
+            'max_pairs' => $maxPairs,
+            'stream' => false
+        ]);
+    }
+
+    public function deleteFace($galleryPath, $employeeId) {
+        // Tombstone every template of an employee; the daemon picks it up without a restart
+        return $this->runDataCommand('delete', [
+            'gallery_path' => $galleryPath,
+            'id' => $employeeId
+        ]);
+    }
+
+    private function runDataCommand($command, $data) {
+        $result = $this->sendToDaemon(['command' => $command] + $data);
+        if($result !== false) {
+            return $result;
+        }
+
+        // Without a daemon the request JSON is piped to the CLI instead of going through a temp file
+        $shellCommand = "python3 {$this->pythonScript} {$command} -";
+        return $this->runWithInput($shellCommand, json_encode($data));
+    }
+
+    private function runWithInput($shellCommand, $input) {
+        $pipes = [];
+        $process = proc_open($shellCommand, [0 => ['pipe', 'r'], 1 => ['pipe', 'w']], $pipes);
+        if(!is_resource($process)) {
+            return false;
+        }
+
+        fwrite($pipes[0], $input);
+        fclose($pipes[0]);
+        $output = stream_get_contents($pipes[1]);
+        fclose($pipes[1]);
+        proc_close($process);
+
         if($output) {
             return json_decode(trim($output), true);
         }
-        
+
         return false;
     }
-}
\ No newline at end of file
+
+    private function encodeFlags($options) {
+        $flags = [
+            'detection_model' => '--model',
+            'upsample' => '--upsample',
+            'num_jitters' => '--jitters',
+            'landmark_model' => '--landmarks',
+            'max_size' => '--max-size',
+            'detect_size' => '--detect-size'
+        ];
+
+        $arguments = empty($options['all_faces']) ? '' : ' --all-faces';
+        foreach($flags as $option => $flag) {
+            if(isset($options[$option])) {
+                $arguments .= " {$flag} " . escapeshellarg($options[$option]);
+            }
+        }
+        return $arguments;
+    }
+
+    private function sendToDaemon($request) {
+        // Returns false when no daemon is listening so callers can fall back to the CLI.
+        // Once the request is sent the daemon may have acted on it, so a lost answer is an error, not a fallback.
+        if(!$this->daemonSocket || !file_exists($this->daemonSocket)) {
+            return false;
+        }
+
+        $connection = @stream_socket_client('unix://' . $this->daemonSocket, $errno, $errstr, 1);
+        if(!$connection) {
+            return false;
+        }
+
+        stream_set_timeout($connection, 30);
+        $written = fwrite($connection, json_encode($request) . "\n");
+        if(!$written) {
+            fclose($connection);
+            return false;
+        }
+        $response = fgets($connection);
+        fclose($connection);
+
+        if($response === false || trim($response) === '') {
+            return ['success' => false, 'error' => 'No answer from the face recognition daemon'];
+        }
+
+        return json_decode(trim($response), true);
+    }
+}
@@ -1,29 +1,303 @@
-
-
 import sys
+import os
 import json
-import face_recognition
-import cv2
+import socket
+import tempfile
+import importlib
+import argparse
+import time
+# cv2, PIL, base64, csv and multiprocessing are imported inside the functions that need them,
+# so short-lived commands such as compare start without loading them
 import numpy as np
-from PIL import Image
-import io
-import base64
+from face_gallery import (FaceGallery, GalleryError, gallery_distances, top_k_indices, search_quantized,
+                          close_pairs)
+import face_index
+import face_timing
+
+# Path of the face_server.py daemon socket; set it to an empty string to always run locally
+DAEMON_SOCKET = os.environ.get(
+    'FACE_RECOGNITION_SOCKET',
+    os.path.join(tempfile.gettempdir(), 'face_recognition.sock')
+)
+
+# Warm-start mode (or --warm): start the daemon on first use instead of loading dlib in every call
+WARM_START = os.environ.get('FACE_RECOGNITION_WARM', '') not in ('', '0')
+DAEMON_START_TIMEOUT = 60
+
+# Detector/encoder settings; every key can be overridden per request or on the command line
+DEFAULT_ENCODE_OPTIONS = {
+    'detection_model': 'hog',   # 'hog' (CPU) or 'cnn'
+    'upsample': 1,              # times to upsample before detecting small faces
+    'num_jitters': 1,           # re-samples averaged per encoding
+    'landmark_model': 'large',  # 'large' (68 points) or 'small' (5 points)
+    'max_size': None,           # longest image side in pixels, None keeps the original
+    'detect_size': 640,         # longest side of the copy faces are detected on, 0 disables
+    'all_faces': False          # return every face in the image instead of only the first
+}
+
+# Compact copy of stored galleries ('float16' or 'int8') scanned before re-ranking in float32;
+# unset scans the float32 rows directly. Requests can override it with 'quantize'.
+GALLERY_QUANTIZATION = os.environ.get('FACE_GALLERY_QUANTIZATION') or None
+# face_benchmark.py identify: int8 only beats the float32 scan on large probe batches, float16 never
+# does, so GALLERY_QUANTIZATION applies from this many probes on
+QUANTIZE_MIN_PROBES = 64
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+BATCH_FLUSH_SIZE = 64
+
+# Set by face_server.py; a one-shot CLI process gains nothing from caching
+recognition_cache = None
+auto_refresh = True
+stage_histograms = None
+request_profiler = None
+
+_face_library = None
+_galleries = {}
+_indexes = {}
+# gallery path -> (GallerySnapshot, IVF index or None) prepared by publish_gallery()
+_published = {}
+
+def get_face_library():
+    """Import the face_recognition package (and its dlib models) on first use"""
+    global _face_library
+    if _face_library is None:
+        # This file is also called face_recognition, so hide it while importing the real package
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        this_module = sys.modules.pop('face_recognition', None)
+        saved_path = sys.path[:]
+        sys.path[:] = [p for p in sys.path if os.path.abspath(p or os.curdir) != script_dir]
+        try:
+            _face_library = importlib.import_module('face_recognition')
+        finally:
+            sys.path[:] = saved_path
+            if this_module is not None:
+                sys.modules['face_recognition'] = this_module
+    return _face_library
+
+def load_gallery(path, create=False):
+    """Open a gallery file once per process and pick up changes on later calls
+
+    face_server.py refreshes open galleries from a background thread and
+    turns auto_refresh off, so searches never wait for a reload.
+    """
+    with face_timing.stage('gallery'):
+        gallery = _galleries.get(path)
+        if gallery is None:
+            gallery = _galleries[path] = FaceGallery.open(path, create=create)
+        elif auto_refresh:
+            gallery.refresh()
+    return gallery
+
+def load_index(gallery):
+    """IVF index for a gallery, kept in memory and rebuilt once it no longer fits the gallery"""
+    index = _indexes.get(gallery.path)
+    if index is None or index.is_stale(len(gallery), gallery.epoch):
+        index = _indexes[gallery.path] = face_index.load_or_build_index(gallery)
+    return index
+
+def publish_gallery(gallery):
+    """Prepare a snapshot of a gallery with its quantized codes and IVF index, then let searches use it
+
+    face_server.py calls this from its refresh thread after every change,
+    so codes and index rebuilds never run inside a search. Searches keep
+    the previous snapshot and index until the new ones are ready.
+    """
+    published = _published.get(gallery.path)
+    if published is not None and published[0].epoch == gallery.epoch and \
+            published[0].generation == gallery.generation:
+        return
+    snapshot = gallery.snapshot()
+    if GALLERY_QUANTIZATION:
+        snapshot.quantized(GALLERY_QUANTIZATION)
+    index = None
+    if len(snapshot) >= face_index.ANN_THRESHOLD:
+        index = _indexes.get(gallery.path)
+        if index is None or index.is_stale(len(snapshot), snapshot.epoch):
+            index = _indexes[gallery.path] = face_index.load_or_build_index(snapshot)
+    _published[gallery.path] = (snapshot, index)
+
+def search_view(gallery):
+    """(snapshot, IVF index or None) for one search of a stored gallery
+
+    Uses what publish_gallery() prepared, moved up to the gallery's
+    latest rows while the file was not compacted since, so an enrolment
+    is visible to the next search. Without a published view the index
+    is None and loaded by the search when needed.
+    """
+    published = _published.get(gallery.path)
+    if published is None:
+        return gallery.snapshot(), None
+    snapshot, index = published
+    if snapshot.generation != gallery.generation and \
+            (index is not None or len(gallery) < face_index.ANN_THRESHOLD):
+        latest = gallery.snapshot()
+        if latest.epoch == snapshot.epoch:
+            # Rows appended since the index was built are scanned exhaustively
+            snapshot = latest
+    return snapshot, index
+
+def encode_options(data=None):
+    """Default encode options overridden by any matching keys in data"""
+    options = dict(DEFAULT_ENCODE_OPTIONS)
+    for key in options:
+        if data and data.get(key) is not None:
+            options[key] = data[key]
+
+    if options['detection_model'] not in ('hog', 'cnn'):
+        raise ValueError(f"Unknown detection_model {options['detection_model']}")
+    if options['landmark_model'] not in ('large', 'small'):
+        raise ValueError(f"Unknown landmark_model {options['landmark_model']}")
+    options['upsample'] = int(options['upsample'])
+    options['num_jitters'] = int(options['num_jitters'])
+    if options['max_size'] is not None:
+        options['max_size'] = int(options['max_size'])
+    options['detect_size'] = int(options['detect_size'] or 0)
+    options['all_faces'] = bool(options['all_faces'])
+    return options
+
+def limit_image_size(image, max_size):
+    """Shrink an image so its longest side is at most max_size pixels"""
+    height, width = image.shape[:2]
+    if not max_size or max(height, width) <= max_size:
+        return image
+
+    import cv2
+    scale = max_size / float(max(height, width))
+    return cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+
+def run_detector(image, options):
+    """(top, right, bottom, left) boxes with detector scores from the dlib detectors"""
+    api = get_face_library().api
+    height, width = image.shape[:2]
+
+    if options['detection_model'] == 'cnn':
+        detections = [(d.rect, d.confidence) for d in api.cnn_face_detector(image, options['upsample'])]
+    else:
+        rects, scores, _ = api.face_detector.run(image, options['upsample'], 0)
+        detections = list(zip(rects, scores))
+
+    return [((max(rect.top(), 0), min(rect.right(), width), min(rect.bottom(), height), max(rect.left(), 0)),
+             float(score)) for rect, score in detections]
+
+def detect_faces(image, options):
+    """Face boxes in full-resolution coordinates with their scores, detected on a downscaled copy
+
+    HOG/CNN detection time grows with pixel count, so large frames are
+    shrunk to detect_size first and the boxes are scaled back up.
+    """
+    height, width = image.shape[:2]
+    with face_timing.stage('detect'):
+        small = limit_image_size(image, options['detect_size'])
+        detections = run_detector(small, options)
+    if small is image:
+        return detections
 
-def encode_face(image_path):
+    scale_y = height / float(small.shape[0])
+    scale_x = width / float(small.shape[1])
+    return [((max(0, int(round(top * scale_y))), min(width, int(round(right * scale_x))),
+              min(height, int(round(bottom * scale_y))), max(0, int(round(left * scale_x)))), score)
+            for (top, right, bottom, left), score in detections]
+
+def decode_image_data(data):
+    """RGB array from raw image bytes or a base64 data URL, without touching the disk"""
+    import base64
+    import io
+    from PIL import Image
+    if isinstance(data, str):
+        data = base64.b64decode(data.split(',', 1)[1] if data.startswith('data:') else data)
+    return np.array(Image.open(io.BytesIO(data)).convert('RGB'))
+
+def load_image(source):
+    """RGB array from a file path, raw bytes, a base64 data URL or an existing array"""
+    if isinstance(source, np.ndarray):
+        return source
+    with face_timing.stage('load_image'):
+        if isinstance(source, (bytes, bytearray)) or source.startswith('data:'):
+            return decode_image_data(source)
+        return get_face_library().load_image_file(source)
+
+def request_image(data):
+    """Image source of a request: base64 'image' (data URL or bare base64) or 'image_path'"""
+    if data.get('image'):
+        image = data['image']
+        return image if image.startswith('data:') else 'data:;base64,' + image
+    return data.get('image_path')
+
+def encode_boxes(image, boxes, options):
+    """Encodings for known face boxes, timing landmarking and the descriptor network separately
+
+    Same steps as face_recognition.face_encodings(), split in two.
+    """
+    api = get_face_library().api
+    with face_timing.stage('landmarks'):
+        landmarks = api._raw_face_landmarks(image, boxes, options['landmark_model'])
+    with face_timing.stage('encode'):
+        return [np.array(api.face_encoder.compute_face_descriptor(image, points, options['num_jitters']))
+                for points in landmarks]
+
+def find_faces(image, options=None, limit=None, detections=None):
+    """Box, detector score and encoding of each face in an image (at most limit faces)
+
+    image can be anything load_image() accepts. detections from an
+    earlier detect_faces() call on the same resized image skip detection.
+    """
+    options = options or encode_options()
+
+    # Load image
+    image = load_image(image)
+    image = limit_image_size(image, options['max_size'])
+
+    # Find face encodings; with known boxes only the full-resolution face regions are read
+    if detections is None:
+        detections = detect_faces(image, options)
+    detections = detections[:limit]
+    face_encodings = encode_boxes(image, [box for box, _ in detections], options)
+
+    return [{'box': box, 'score': score, 'encoding': encoding}
+            for (box, score), encoding in zip(detections, face_encodings)]
+
+def find_face_encoding(image, options=None):
+    """Encoding of the first face in an image, or None if there is no face"""
+    faces = find_faces(image, options, limit=1)
+
+    # Return the first face encoding found
+    return faces[0]['encoding'] if faces else None
+
+def face_result(face):
+    """JSON-friendly form of one find_faces() entry"""
+    top, right, bottom, left = face['box']
+    return {
+        'box': {'top': top, 'right': right, 'bottom': bottom, 'left': left},
+        'score': face['score'],
+        'encoding': face['encoding'].tolist()
+    }
+
+def encode_face(image, options=None):
     """Extract face encoding from image"""
     try:
-        # Load image
-        image = face_recognition.load_image_file(image_path)
-        
-        # Find face encodings
-        face_encodings = face_recognition.face_encodings(image)
-        
-        if len(face_encodings) > 0:
-            # Return the first face encoding found
-            encoding = face_encodings[0].tolist()
+        options = encode_options(options)
+        if options['all_faces']:
+            faces = [face_result(face) for face in find_faces(image, options)]
+            if not faces:
+                return json.dumps({
+                    'success': False,
+                    'error': 'No face found in image'
+                })
             return json.dumps({
                 'success': True,
-                'encoding': encoding
+                'encoding': faces[0]['encoding'],
+                'faces': faces,
+                'settings': options
+            })
+
+        encoding = find_face_encoding(image, options)
+
+        if encoding is not None:
+            encoding = encoding.tolist()
+            return json.dumps({
+                'success': True,
+                'encoding': encoding,
+                'settings': options
             })
         else:
             return json.dumps({
@@ -37,22 +311,43 @@ def encode_face(image_path):
         })
 
 def compare_faces(data_file):
-    """Compare two face encodings"""
+    """Compare two face encodings stored in a JSON data file"""
     try:
         with open(data_file, 'r') as f:
             data = json.load(f)
-        
+    except Exception as e:
+        return json.dumps({
+            'success': False,
+            'error': str(e)
+        })
+
+    return compare_data(data)
+
+def probe_from_image(data, image=None):
+    """Encode the face in a request's image, for commands that take a probe encoding"""
+    options = encode_options(data)
+    encoding = find_face_encoding(request_image(data) if image is None else image, options)
+    if encoding is None:
+        raise ValueError('No face found in image')
+    return encoding, options
+
+def compare_data(data):
+    """Compare two face encodings; encoding1 may be replaced by an image"""
+    try:
+        if 'encoding1' not in data and request_image(data):
+            data = dict(data, encoding1=probe_from_image(data)[0])
         encoding1 = np.array(data['encoding1'])
         encoding2 = np.array(data['encoding2'])
         tolerance = data.get('tolerance', 0.6)
-        
-        # Calculate face distance
-        distance = face_recognition.face_distance([encoding1], encoding2)[0]
-        
+
+        # Same Euclidean distance as face_recognition.face_distance(), without loading dlib
+        with face_timing.stage('distance'):
+            distance = float(np.linalg.norm(encoding1 - encoding2))
+
         # Convert distance to confidence
-        confidence = max(0, 1 - distance)
+        confidence = max(0.0, 1 - distance)
         is_match = distance <= tolerance
-        
+
         return json.dumps({
             'success': True,
             'is_match': is_match,
@@ -65,18 +360,687 @@ def compare_faces(data_file):
             'error': str(e)
         })
 
+def encoding_set(data, suffix):
+    """(encodings, ids, alive mask) of one side of a compare-matrix request"""
+    if data.get('gallery_path' + suffix):
+        snapshot = load_gallery(data['gallery_path' + suffix]).snapshot()
+        alive = snapshot.alive if snapshot.has_deletions else None
+        return snapshot.encodings, snapshot.ids, alive
+
+    encodings = np.ascontiguousarray(data['encodings' + suffix], dtype=np.float32)
+    ids = data.get('ids' + suffix) or list(range(len(encodings)))
+    if len(ids) != len(encodings):
+        raise ValueError('ids and encodings must have the same length')
+    return encodings, ids, None
+
+def compare_matrix_data(data, out=None):
+    """All pairs of encodings within tolerance between two sets, or within one set
+
+    Set 1 is 'encodings1' (with optional 'ids1') or 'gallery_path1'; set 2
+    likewise. Without a set 2 the first set is compared with itself, which
+    is how duplicate enrolments are found; there, pairs sharing an id are
+    skipped unless 'same_id' is true. With out, pairs are written to it as
+    JSON lines while they are found and only a summary is returned;
+    otherwise at most 'max_pairs' pairs are returned in the result.
+    """
+    try:
+        if 'gallery_path' in data and 'gallery_path1' not in data:
+            data = dict(data, gallery_path1=data['gallery_path'])
+        encodings1, ids1, alive1 = encoding_set(data, '1')
+        has_second = data.get('gallery_path2') or 'encodings2' in data
+        encodings2, ids2, alive2 = encoding_set(data, '2') if has_second else (None, ids1, None)
+        tolerance = data.get('tolerance', 0.6)
+        block_rows = int(data.get('block_rows', 2048))
+        max_pairs = int(data.get('max_pairs', 100000))
+        skip_same_id = not has_second and not data.get('same_id', False)
+
+        pairs = []
+        found = 0
+        with face_timing.stage('distance'):
+            candidates = close_pairs(encodings1, encodings2, tolerance, block_rows, alive1, alive2)
+            for row1, row2, distance in candidates:
+                if skip_same_id and ids1[row1] == ids2[row2]:
+                    continue
+                found += 1
+                pair = {'row1': row1, 'row2': row2, 'id1': ids1[row1], 'id2': ids2[row2],
+                        'distance': distance, 'confidence': max(0.0, 1 - distance)}
+                if out is not None:
+                    out.write(json.dumps(pair) + '\n')
+                elif len(pairs) < max_pairs:
+                    pairs.append(pair)
+
+        result = {'success': True, 'count': found}
+        if out is None:
+            result['pairs'] = pairs
+            result['truncated'] = found > len(pairs)
+        return json.dumps(result)
+    except Exception as e:
+        return json.dumps({
+            'success': False,
+            'error': str(e)
+        })
+
+def settings_comparable(probe_settings, stored_settings):
+    """Whether two encodings were produced with the same landmark model, or None if unknown"""
+    if not probe_settings or not stored_settings:
+        return None
+    return probe_settings.get('landmark_model', 'large') == stored_settings.get('landmark_model', 'large')
+
+def format_matches(distances, indices, ids, tolerance, probe_settings=None, row_settings=None):
+    """Build the per-probe match lists returned by identify"""
+    results = []
+    for probe_distances, columns in zip(distances, indices):
+        matches = []
+        for distance, column in zip(probe_distances, columns):
+            distance = float(distance)
+            if not np.isfinite(distance):
+                # Deleted rows are pushed to infinity rather than removed from the matrix
+                continue
+            matches.append({
+                'id': ids[column],
+                'distance': distance,
+                'confidence': max(0.0, 1 - distance),
+                'is_match': distance <= tolerance
+            })
+            if probe_settings and row_settings is not None:
+                matches[-1]['comparable'] = settings_comparable(probe_settings, row_settings[column])
+        best = matches[0] if matches and matches[0]['is_match'] else None
+        results.append({'match': best, 'matches': matches})
+    return results
+
+def identify_templates(probes, gallery, templates, top_k, shortlist, alive=None):
+    """Top-k identities per probe when identities have several templates
+
+    Identities are first shortlisted by centroid distance, then each
+    shortlisted identity scores the distance of its closest template.
+    Returns (distances, rows) lists with the row of each best template.
+    """
+    centroid_distances = gallery_distances(probes, templates.centroids)
+    shortlists = top_k_indices(centroid_distances, max(shortlist, top_k))
+
+    all_distances, all_rows = [], []
+    for probe, candidates in zip(probes, shortlists):
+        # Skip rows appended after this search's snapshot and deleted rows
+        groups = [[row for row in templates.rows[c] if row < len(gallery) and (alive is None or alive[row])]
+                  for c in candidates]
+        groups = [group for group in groups if group]
+        if not groups:
+            all_distances.append([])
+            all_rows.append([])
+            continue
+
+        rows = np.fromiter((row for group in groups for row in group), dtype=np.int64)
+        starts = np.cumsum([0] + [len(group) for group in groups[:-1]])
+
+        distances = gallery_distances(probe[None, :], gallery[rows])[0]
+        best = np.minimum.reduceat(distances, starts)
+        best_rows = [rows[start + int(np.argmin(distances[start:start + len(group)]))]
+                     for start, group in zip(starts, groups)]
+
+        nearest = top_k_indices(best[None, :], top_k)[0]
+        all_distances.append(best[nearest])
+        all_rows.append([best_rows[i] for i in nearest])
+    return all_distances, all_rows
+
+def identify_data(data):
+    """Find the closest gallery encodings for one probe encoding or a batch of them
+
+    Instead of probe/probes the request may carry an image, which is
+    encoded first so a recognition needs only one call. When the daemon
+    has a recognition cache, faces nearly identical to those of a recent
+    frame against a gallery file get the earlier answer back; only
+    detection runs, landmarking and encoding are skipped.
+    """
+    try:
+        faces = None
+        cache_key = None
+        if 'probe' not in data and 'probes' not in data and request_image(data):
+            settings = encode_options(data)
+            image = limit_image_size(load_image(request_image(data)), settings['max_size'])
+            detections = detect_faces(image, settings)
+            if not settings['all_faces']:
+                detections = detections[:1]
+
+            if recognition_cache is not None and 'gallery_path' in data and detections:
+                context = json.dumps([data['gallery_path'], load_gallery(data['gallery_path']).generation,
+                                      data.get('track_id'), data.get('tolerance', 0.6),
+                                      data.get('top_k', 1), data.get('exact', False),
+                                      data.get('quantize', GALLERY_QUANTIZATION), data.get('rerank', 32),
+                                      data.get('n_probe', face_index.DEFAULT_N_PROBE),
+                                      data.get('shortlist', 32), settings],
+                                     sort_keys=True)
+                cache_key = recognition_cache.key(image, [box for box, _ in detections], context)
+                cached = recognition_cache.get(cache_key)
+                if cached is not None:
+                    return cached
+
+            found = find_faces(image, settings, detections=detections)
+            if settings['all_faces']:
+                # Every face in the frame becomes a probe in the same distance pass
+                faces = [face_result(face) for face in found]
+                if not faces:
+                    return json.dumps({'success': True, 'results': []})
+                data = dict(data, probes=[face['encoding'] for face in faces], settings=settings)
+            else:
+                if not found:
+                    raise ValueError('No face found in image')
+                data = dict(data, probe=found[0]['encoding'], settings=settings)
+
+        row_settings = None
+        snapshot = index = None
+        if 'gallery_path' in data:
+            # One consistent view, even if a refresh lands while this search runs
+            stored = load_gallery(data['gallery_path'])
+            snapshot, index = search_view(stored)
+            gallery, ids, row_settings = snapshot.encodings, snapshot.ids, snapshot.settings
+        else:
+            gallery = np.ascontiguousarray(data['gallery'], dtype=np.float32)
+            ids = data.get('ids') or list(range(len(gallery)))
+            if len(ids) != len(gallery):
+                raise ValueError('ids and gallery must have the same length')
+        probe_settings = data.get('settings')
+        tolerance = data.get('tolerance', 0.6)
+        top_k = int(data.get('top_k', 1))
+
+        probes = data['probes'] if 'probes' in data else [data['probe']]
+        probes = np.ascontiguousarray(probes, dtype=np.float32)
+
+        templates = snapshot.templates if snapshot is not None else None
+        alive = snapshot.alive if snapshot is not None and snapshot.has_deletions else None
+        quantize = None
+        if snapshot is not None:
+            quantize = data['quantize'] if 'quantize' in data else \
+                GALLERY_QUANTIZATION if len(probes) >= QUANTIZE_MIN_PROBES else None
+
+        with face_timing.stage('distance'):
+            if len(gallery) == 0:
+                results = [{'match': None, 'matches': []} for _ in probes]
+            elif templates is not None and templates.has_multiple_templates() and \
+                    (data.get('exact') or len(gallery) < face_index.ANN_THRESHOLD):
+                # Several templates per employee: rank employees, not rows; exact=true shortlists everyone
+                shortlist = len(templates.identities) if data.get('exact') else int(data.get('shortlist', 32))
+                distances, indices = identify_templates(probes, gallery, templates, top_k, shortlist, alive)
+                results = format_matches(distances, indices, ids, tolerance, probe_settings, row_settings)
+            elif quantize and not data.get('exact'):
+                # Coarse pass over the compact codes, then the best candidates are re-ranked in float32
+                codes, code_sq_norms, scale = snapshot.quantized(quantize)
+                rerank = int(data.get('rerank', 32))
+                distances, indices = search_quantized(probes, codes, code_sq_norms, scale, gallery,
+                                                      top_k, rerank, alive)
+                results = format_matches(distances, indices, ids, tolerance, probe_settings, row_settings)
+            elif snapshot is not None and not data.get('exact') and len(gallery) >= face_index.ANN_THRESHOLD:
+                # Large stored galleries go through the approximate index; exact=true forces a full scan
+                n_probe = int(data.get('n_probe', face_index.DEFAULT_N_PROBE))
+                index = index or load_index(stored)
+                if index.epoch != snapshot.epoch or index.count > len(snapshot):
+                    # A compaction renumbered the rows after the snapshot was taken
+                    raise GalleryError('Gallery was compacted during the search, retry')
+                distances, indices = index.search(probes, gallery, top_k, n_probe, alive)
+                results = format_matches(distances, indices, ids, tolerance, probe_settings, row_settings)
+            else:
+                sq_norms = snapshot.sq_norms if snapshot is not None else None
+                distances = gallery_distances(probes, gallery, sq_norms)
+                if alive is not None:
+                    distances[:, ~alive] = np.inf
+                indices = top_k_indices(distances, top_k)
+                results = format_matches(np.take_along_axis(distances, indices, axis=1), indices, ids,
+                                         tolerance, probe_settings, row_settings)
+
+        if faces is not None:
+            for result, face in zip(results, faces):
+                result['box'] = face['box']
+                result['score'] = face['score']
+
+        response = json.dumps({
+            'success': True,
+            'results': results
+        })
+        if cache_key is not None:
+            recognition_cache.put(cache_key, response)
+        return response
+    except Exception as e:
+        return json.dumps({
+            'success': False,
+            'error': str(e)
+        })
+
+def enroll_data(data):
+    """Append one or more encodings (or the face in an image) to a gallery file"""
+    try:
+        if request_image(data):
+            encoded = json.loads(encode_face(request_image(data), data))
+            if not encoded['success']:
+                return json.dumps(encoded)
+            encodings = [encoded['encoding']]
+            settings = encoded['settings']
+        else:
+            encodings = data['encodings'] if 'encodings' in data else [data['encoding']]
+            settings = data.get('settings')
+
+        ids = data['ids'] if 'ids' in data else [data['id']]
+        names = data['names'] if 'names' in data else [data.get('name')] * len(ids)
+
+        gallery = load_gallery(data['gallery_path'], create=True)
+        first_row = gallery.append(encodings, ids, names, settings)
+
+        return json.dumps({
+            'success': True,
+            'rows': list(range(first_row, first_row + len(ids))),
+            'gallery_size': gallery.live_count()
+        })
+    except Exception as e:
+        return json.dumps({
+            'success': False,
+            'error': str(e)
+        })
+
+def delete_data(data):
+    """Remove every template of one or more ids from a gallery file"""
+    try:
+        ids = data['ids'] if 'ids' in data else [data['id']]
+        gallery = load_gallery(data['gallery_path'])
+        removed = gallery.delete(ids)
+
+        return json.dumps({
+            'success': True,
+            'removed': removed,
+            'gallery_size': gallery.live_count()
+        })
+    except Exception as e:
+        return json.dumps({
+            'success': False,
+            'error': str(e)
+        })
+
+def compact_data(data):
+    """Rewrite a gallery file without its deleted rows"""
+    try:
+        gallery = load_gallery(data['gallery_path'])
+        return json.dumps({
+            'success': True,
+            'gallery_size': gallery.compact()
+        })
+    except Exception as e:
+        return json.dumps({
+            'success': False,
+            'error': str(e)
+        })
+
+def build_index_data(data):
+    """Rebuild the IVF index next to a gallery file and report its recall against a full scan"""
+    try:
+        gallery = load_gallery(data['gallery_path'])
+        index = face_index.IVFIndex.build(gallery.encodings, data.get('n_lists'), epoch=gallery.epoch)
+        index.save(face_index.index_path_for(gallery.path))
+        _indexes[gallery.path] = index
+
+        n_probe = int(data.get('n_probe', face_index.DEFAULT_N_PROBE))
+        return json.dumps({
+            'success': True,
+            'n_lists': index.n_lists,
+            'n_probe': n_probe,
+            'recall': face_index.measure_recall(index, gallery.encodings, n_probe=n_probe)
+        })
+    except Exception as e:
+        return json.dumps({
+            'success': False,
+            'error': str(e)
+        })
+
+def iter_batch_sources(source):
+    """Yield (id, name, image_path) from a directory of images or a CSV manifest"""
+    import csv
+    if os.path.isdir(source):
+        for entry in sorted(os.scandir(source), key=lambda e: e.name):
+            if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.splitext(entry.name)[0], None, entry.path
+    else:
+        # Manifest columns: image_path, plus optional id and name
+        base_dir = os.path.dirname(os.path.abspath(source))
+        with open(source, 'r', newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                image_path = os.path.join(base_dir, row['image_path'])
+                entry_id = row.get('id') or os.path.splitext(os.path.basename(image_path))[0]
+                yield entry_id, row.get('name') or None, image_path
+
+def _encode_batch_item(item, options=None):
+    # Runs in a worker process; the face library is loaded once per worker
+    entry_id, name, image_path = item
+    try:
+        encoding = find_face_encoding(image_path, options)
+        if encoding is None:
+            return entry_id, name, image_path, None, 'No face found in image'
+        return entry_id, name, image_path, encoding, None
+    except Exception as e:
+        return entry_id, name, image_path, None, str(e)
+
+def encode_batch(data):
+    """Encode every image from a directory or manifest into a gallery using all cores"""
+    import functools
+    import multiprocessing
+    try:
+        gallery = load_gallery(data['gallery_path'], create=True)
+        report_path = data.get('report_path') or data['gallery_path'] + '.errors.jsonl'
+        workers = int(data.get('workers') or multiprocessing.cpu_count())
+        options = encode_options(data)
+
+        # Ids already in the gallery were enrolled by an earlier run, so a rerun resumes
+        enrolled = gallery.live_ids()
+        pending = (item for item in iter_batch_sources(data['source']) if item[0] not in enrolled)
+
+        counts = {'encoded': 0, 'failed': 0}
+        buffer = []
+
+        def flush():
+            if buffer:
+                gallery.append([b[3] for b in buffer], [b[0] for b in buffer],
+                               [b[1] for b in buffer], options)
+                counts['encoded'] += len(buffer)
+                del buffer[:]
+
+        with open(report_path, 'a', encoding='utf-8') as report, \
+                multiprocessing.Pool(workers) as pool:
+            encode_item = functools.partial(_encode_batch_item, options=options)
+            for entry_id, name, image_path, encoding, error in pool.imap_unordered(
+                    encode_item, pending, chunksize=4):
+                if error:
+                    counts['failed'] += 1
+                    report.write(json.dumps({'id': entry_id, 'image_path': image_path, 'error': error}) + '\n')
+                    report.flush()
+                elif entry_id not in enrolled:
+                    enrolled.add(entry_id)
+                    buffer.append((entry_id, name, image_path, encoding))
+                    if len(buffer) >= BATCH_FLUSH_SIZE:
+                        flush()
+            flush()
+
+        return json.dumps({
+            'success': True,
+            'encoded': counts['encoded'],
+            'failed': counts['failed'],
+            'gallery_size': gallery.live_count(),
+            'report_path': report_path
+        })
+    except Exception as e:
+        return json.dumps({
+            'success': False,
+            'error': str(e)
+        })
+
+def handle_request(request):
+    """Run a command described by a request dict and return the JSON result
+
+    With 'timings': true the response also carries the milliseconds spent
+    in each stage (load_image, detect, landmarks, encode, gallery,
+    distance) and in total.
+    """
+    if not request.get('timings') and stage_histograms is None and request_profiler is None:
+        return run_command(request)
+
+    with face_timing.collect() as timings:
+        if request_profiler is not None:
+            response = request_profiler.run(run_command, request)
+        else:
+            response = run_command(request)
+
+    if stage_histograms is not None:
+        stage_histograms.record(request.get('command'), timings)
+    if request.get('timings'):
+        result = json.loads(response)
+        result['timings'] = {name: round(elapsed, 3) for name, elapsed in timings.items()}
+        response = json.dumps(result)
+    return response
+
+def run_command(request):
+    command = request.get('command')
+
+    if command == "encode" and request_image(request):
+        return encode_face(request_image(request), request)
+    elif command == "compare":
+        return compare_data(request)
+    elif command == "compare-matrix":
+        return compare_matrix_data(request)
+    elif command == "identify":
+        return identify_data(request)
+    elif command == "enroll":
+        return enroll_data(request)
+    elif command == "delete":
+        return delete_data(request)
+    elif command == "compact":
+        return compact_data(request)
+    elif command == "build-index":
+        return build_index_data(request)
+    elif command == "encode-batch":
+        return encode_batch(request)
+    elif command == "cache-stats":
+        stats = recognition_cache.stats() if recognition_cache is not None else None
+        return json.dumps({'success': True, 'cache': stats})
+    elif command == "timing-stats":
+        stats = stage_histograms.snapshot() if stage_histograms is not None else None
+        return json.dumps({'success': True, 'timings': stats})
+    elif command == "profile":
+        return profile_data(request)
+    else:
+        return json.dumps({'error': 'Invalid command or arguments'})
+
+def profile_data(data):
+    """Profile the daemon's next N requests; the report path is returned straight away"""
+    try:
+        if request_profiler is None:
+            raise RuntimeError('Profiling is only available in the daemon')
+        path = request_profiler.start(data.get('requests', 10), data.get('kind', 'cpu'), data.get('output'))
+        return json.dumps({'success': True, 'output': path})
+    except Exception as e:
+        return json.dumps({
+            'success': False,
+            'error': str(e)
+        })
+
+# Request keys that change how identify ranks and reports matches
+IDENTIFY_BATCH_KEYS = ('gallery_path', 'tolerance', 'top_k', 'exact', 'quantize',
+                       'rerank', 'n_probe', 'shortlist', 'settings')
+
+def batch_key(request):
+    """Key shared by the requests handle_batch() can answer with one distance pass, or None"""
+    if request.get('command') == 'identify' and 'gallery_path' in request and \
+            ('probe' in request or 'probes' in request):
+        return json.dumps([request.get(k) for k in IDENTIFY_BATCH_KEYS], sort_keys=True)
+    return None
+
+def handle_batch(requests):
+    """Run several requests and return their JSON results in the same order
+
+    Identify requests that carry probe encodings and search the same
+    gallery with the same options share one distance pass.
+    """
+    responses = [None] * len(requests)
+    groups = {}
+    for i, request in enumerate(requests):
+        key = batch_key(request)
+        if key is not None:
+            groups.setdefault(key, []).append(i)
+        else:
+            responses[i] = handle_request(request)
+
+    for members in groups.values():
+        probes, counts = [], []
+        for i in members:
+            request_probes = requests[i]['probes'] if 'probes' in requests[i] else [requests[i]['probe']]
+            probes.extend(request_probes)
+            counts.append(len(request_probes))
+
+        merged = {k: v for k, v in requests[members[0]].items() if k != 'probe'}
+        result = json.loads(identify_data(dict(merged, probes=probes)))
+        if not result['success']:
+            # Let each request report its own error
+            for i in members:
+                responses[i] = identify_data(requests[i])
+            continue
+
+        start = 0
+        for i, count in zip(members, counts):
+            responses[i] = json.dumps({'success': True, 'results': result['results'][start:start + count]})
+            start += count
+    return responses
+
+def send_to_daemon(request, socket_path=None, timeout=30):
+    """Forward a request to a running face_server.py, or return None if none is listening
+
+    Only a request that could not be sent returns None. Once it was sent
+    the daemon may already have acted on it (an enroll, a delete), so a
+    lost answer is reported as an error instead of running it again here.
+    """
+    socket_path = DAEMON_SOCKET if socket_path is None else socket_path
+    if not socket_path or not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return None
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(socket_path)
+            sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        except OSError:
+            return None
+
+        try:
+            with sock.makefile('r', encoding='utf-8') as f:
+                response = f.readline().strip()
+        except OSError as e:
+            return json.dumps({'success': False, 'error': f"No answer from the face recognition daemon: {e}"})
+
+    return response or json.dumps({'success': False, 'error': 'The face recognition daemon closed the connection'})
+
+def daemon_ready(socket_path):
+    response = send_to_daemon({'command': 'cache-stats'}, socket_path, timeout=5)
+    return response is not None and json.loads(response).get('success', False)
+
+def start_daemon(socket_path=None, timeout=DAEMON_START_TIMEOUT):
+    """Start face_server.py in the background and wait until it answers
+
+    The first call pays for loading the models once; every later call,
+    from any process, reuses the running daemon. Returns True once the
+    daemon is ready.
+    """
+    socket_path = DAEMON_SOCKET if socket_path is None else socket_path
+    if not socket_path or not hasattr(socket, 'AF_UNIX'):
+        return False
+
+    import fcntl
+    import subprocess
+    # Concurrent first calls must not start two daemons on the same socket
+    with open(socket_path + '.start.lock', 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        if daemon_ready(socket_path):
+            return True
+
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'face_server.py')
+        with open(os.path.join(tempfile.gettempdir(), 'face_server.log'), 'ab') as log:
+            subprocess.Popen([sys.executable, script, '--socket', socket_path],
+                             stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
+
+        deadline = time.time() + timeout
+        delay = 0.05
+        while time.time() < deadline:
+            if daemon_ready(socket_path):
+                return True
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+    return False
+
+def add_encode_arguments(parser):
+    """Command line flags for the encode options, shared with face_server.py"""
+    parser.add_argument('--model', dest='detection_model', choices=('hog', 'cnn'),
+                        help='face detector (default hog)')
+    parser.add_argument('--upsample', type=int, help='times to upsample before detecting (default 1)')
+    parser.add_argument('--jitters', dest='num_jitters', type=int,
+                        help='re-samples averaged per encoding (default 1)')
+    parser.add_argument('--landmarks', dest='landmark_model', choices=('large', 'small'),
+                        help='landmark model used to align faces (default large)')
+    parser.add_argument('--max-size', dest='max_size', type=int,
+                        help='downscale images so the longest side is at most this many pixels')
+    parser.add_argument('--detect-size', dest='detect_size', type=int,
+                        help='longest side of the copy used for face detection (default 640, 0 disables)')
+    parser.add_argument('--all-faces', dest='all_faces', action='store_true', default=None,
+                        help='return every face in the image with its box and detector score')
+    return parser
+
+def parse_encode_flags(args):
+    """Split CLI arguments into positional arguments and encode option overrides"""
+    parser = add_encode_arguments(argparse.ArgumentParser(prog='face_recognition.py'))
+    parser.add_argument('--workers', type=int, help='worker processes for encode-batch')
+    parser.add_argument('--timings', action='store_true', default=None,
+                        help='include per-stage timings in the JSON result')
+    flags, positional = parser.parse_known_args(args)
+    return positional, {key: value for key, value in vars(flags).items() if value is not None}
+
+# Request keys holding file paths
+REQUEST_PATH_KEYS = ('gallery_path', 'gallery_path1', 'gallery_path2', 'image_path')
+
+def build_request(args):
+    """Turn CLI arguments into a request dict"""
+    args, flags = parse_encode_flags(args)
+    command = args[0]
+
+    if command == "encode" and len(args) >= 2:
+        if args[1] == '-':
+            # Raw image bytes or a data URL on stdin, sent on as base64
+            import base64
+            raw = sys.stdin.buffer.read().strip()
+            image = raw.decode('ascii') if raw.startswith(b'data:') else base64.b64encode(raw).decode('ascii')
+            return dict(flags, command='encode', image=image)
+        return dict(flags, command='encode', image_path=os.path.abspath(args[1]))
+    elif command in ("compare", "compare-matrix", "identify", "enroll", "delete", "compact",
+                     "build-index") and len(args) >= 2:
+        # The request JSON comes from a data file, or from stdin when the file is '-'
+        if args[1] == '-':
+            data = json.load(sys.stdin)
+        else:
+            with open(args[1], 'r') as f:
+                data = json.load(f)
+        data['command'] = command
+        # The daemon has its own working directory, so relative paths are resolved here
+        for key in REQUEST_PATH_KEYS:
+            if data.get(key):
+                data[key] = os.path.abspath(data[key])
+        if flags.get('timings'):
+            data['timings'] = True
+        return data
+    elif command == "encode-batch" and len(args) >= 3:
+        request = dict(flags, command='encode-batch', source=os.path.abspath(args[1]),
+                       gallery_path=os.path.abspath(args[2]))
+        if len(args) >= 4:
+            request['workers'] = int(args[3])
+        return request
+    return None
+
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print(json.dumps({'error': 'No command specified'}))
         sys.exit(1)
-    
-    command = sys.argv[1]
-    
-    if command == "encode" and len(sys.argv) >= 3:
-        result = encode_face(sys.argv[2])
-        print(result)
-    elif command == "compare" and len(sys.argv) >= 3:
-        result = compare_faces(sys.argv[2])
-        print(result)
+
+    args = sys.argv[1:]
+    warm_start = WARM_START or '--warm' in args
+    args = [arg for arg in args if arg != '--warm']
+
+    try:
+        request = build_request(args)
+    except Exception as e:
+        print(json.dumps({'success': False, 'error': str(e)}))
+        sys.exit(1)
+
+    if request is None:
+        print(json.dumps({'error': 'Invalid command or arguments'}))
     else:
-        print(json.dumps({'error': 'Invalid command or arguments'}))
\ No newline at end of file
+        # Use the warm daemon when one is running, otherwise do the work in this process.
+        # Bulk enrolment always runs here since it brings its own worker pool, and
+        # compare-matrix does so it can stream its pairs instead of collecting them
+        # (unless the request sets 'stream' to false).
+        result = None
+        if request['command'] == 'compare-matrix' and request.get('stream', True):
+            result = compare_matrix_data(request, out=sys.stdout)
+        elif request['command'] != 'encode-batch':
+            result = send_to_daemon(request)
+            if result is None and warm_start and start_daemon():
+                result = send_to_daemon(request)
+        result = result or handle_request(request)
+        print(result)
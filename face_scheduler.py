@@ -0,0 +1,211 @@
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import face_recognition
+
+# Commands that run in the front process because they only read scheduler state
+LOCAL_COMMANDS = ('scheduler-stats',)
+
+def _init_worker(encode_options, quantize):
+    """Give each pool process the daemon's settings and load dlib once"""
+    face_recognition.DEFAULT_ENCODE_OPTIONS.update(encode_options)
+    face_recognition.GALLERY_QUANTIZATION = quantize
+    face_recognition.get_face_library()
+
+class PendingRequest:
+    def __init__(self, request, future, expires_at):
+        self.request = request
+        self.future = future
+        self.expires_at = expires_at
+
+class BatchScheduler:
+    """Queue requests, group them into micro-batches and run them on a process pool
+
+    Only identify requests that handle_batch() can answer with one
+    distance pass are grouped: such a batch is sent once it holds
+    max_batch requests for the same gallery and options or its first
+    request has waited max_wait_ms. Any other request goes to the next
+    free worker on its own, so a burst spreads over the pool. At most
+    one batch per worker is in flight; once max_queue requests are waiting, new ones are rejected
+    straight away instead of piling up. Every request has a deadline:
+    requests still queued when it passes are dropped without running,
+    and the client gets a timeout error either way. A pool whose worker
+    died is replaced.
+    """
+
+    def __init__(self, workers=None, max_batch=16, max_wait_ms=5.0, max_queue=256,
+                 deadline_ms=10000.0, encode_options=None, quantize=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_queue = max_queue
+        self.deadline = deadline_ms / 1000.0
+        self.encode_options = dict(encode_options or face_recognition.DEFAULT_ENCODE_OPTIONS)
+        self.quantize = quantize
+        self.stats = {'requests': 0, 'batches': 0, 'batched_requests': 0, 'rejected': 0, 'expired': 0,
+                      'pool_restarts': 0}
+        self.queue = None
+        # Requests taken off the queue while collecting a batch they do not belong to
+        self._held = collections.deque()
+        self.pool = None
+        self._slots = None
+        self._batcher = None
+
+    async def start(self):
+        self.queue = asyncio.Queue(self.max_queue)
+        self._slots = asyncio.Semaphore(self.workers)
+        self.pool = self._new_pool()
+        self._batcher = asyncio.ensure_future(self._run_batches())
+
+    def _new_pool(self):
+        return concurrent.futures.ProcessPoolExecutor(
+            self.workers, initializer=_init_worker, initargs=(self.encode_options, self.quantize))
+
+    async def close(self):
+        if self._batcher is not None:
+            self._batcher.cancel()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+    async def submit(self, request):
+        """Schedule one request and wait for its JSON result"""
+        loop = asyncio.get_event_loop()
+        self.stats['requests'] += 1
+        if request.get('command') in LOCAL_COMMANDS:
+            return json.dumps({'success': True, 'scheduler': self.snapshot_stats()})
+
+        deadline = request.pop('deadline_ms', None)
+        deadline = self.deadline if deadline is None else float(deadline) / 1000.0
+        pending = PendingRequest(request, loop.create_future(), loop.time() + deadline)
+        try:
+            self.queue.put_nowait(pending)
+        except asyncio.QueueFull:
+            self.stats['rejected'] += 1
+            return json.dumps({'success': False, 'error': 'Server busy, retry later', 'busy': True})
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(pending.future), deadline)
+        except asyncio.TimeoutError:
+            return json.dumps({'success': False, 'error': 'Deadline exceeded', 'timeout': True})
+
+    async def _collect_batch(self):
+        loop = asyncio.get_event_loop()
+        first = self._held.popleft() if self._held else await self.queue.get()
+        key = face_recognition.batch_key(first.request)
+        if key is None:
+            return [first]
+
+        batch = [first]
+        for pending in list(self._held):
+            if len(batch) < self.max_batch and face_recognition.batch_key(pending.request) == key:
+                self._held.remove(pending)
+                batch.append(pending)
+        flush_at = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = flush_at - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                pending = await asyncio.wait_for(self.queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if face_recognition.batch_key(pending.request) == key:
+                batch.append(pending)
+            else:
+                # Served by a later batch, in arrival order
+                self._held.append(pending)
+        return batch
+
+    async def _run_batches(self):
+        while True:
+            # Wait for a free worker first, so the queue is what absorbs a burst
+            await self._slots.acquire()
+            try:
+                batch = await self._collect_batch()
+            except asyncio.CancelledError:
+                self._slots.release()
+                raise
+
+            now = asyncio.get_event_loop().time()
+            live = [p for p in batch if p.expires_at > now and not p.future.done()]
+            self.stats['expired'] += len(batch) - len(live)
+            if not live:
+                self._slots.release()
+                continue
+            asyncio.ensure_future(self._dispatch(live))
+
+    async def _dispatch(self, batch):
+        loop = asyncio.get_event_loop()
+        self.stats['batches'] += 1
+        self.stats['batched_requests'] += len(batch)
+        pool = self.pool
+        try:
+            responses = await loop.run_in_executor(
+                pool, face_recognition.handle_batch, [p.request for p in batch])
+        except BrokenProcessPool:
+            # A worker died (killed, out of memory); every later request would fail the same way
+            if self.pool is pool:
+                pool.shutdown(wait=False)
+                self.pool = self._new_pool()
+                self.stats['pool_restarts'] += 1
+            error = 'A worker process died, retry the request'
+            responses = [json.dumps({'success': False, 'error': error})] * len(batch)
+        except Exception as e:
+            responses = [json.dumps({'success': False, 'error': str(e)})] * len(batch)
+        finally:
+            self._slots.release()
+
+        for pending, response in zip(batch, responses):
+            if not pending.future.done():
+                pending.future.set_result(response)
+
+    def snapshot_stats(self):
+        batches = self.stats['batches']
+        return dict(self.stats, workers=self.workers, queued=self.queue.qsize() + len(self._held),
+                    mean_batch=self.stats['batched_requests'] / float(batches) if batches else 0.0)
+
+    async def handle_client(self, reader, writer):
+        """Serve newline-delimited JSON requests on one connection, answering in order"""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if not line:
+                    continue
+
+                try:
+                    response = await self.submit(json.loads(line.decode('utf-8')))
+                except Exception as e:
+                    response = json.dumps({'success': False, 'error': str(e)})
+                writer.write((response + '\n').encode('utf-8'))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+async def serve(scheduler, socket_path=None, port=None, socket_mode=0o660):
+    """Run the asyncio front end until cancelled"""
+    await scheduler.start()
+    if port:
+        server = await asyncio.start_server(scheduler.handle_client, '127.0.0.1', port)
+    else:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = await asyncio.start_unix_server(scheduler.handle_client, socket_path)
+        os.chmod(socket_path, socket_mode)
+
+    where = f"127.0.0.1:{port}" if port else socket_path
+    print(f"Face recognition daemon listening on {where} with {scheduler.workers} workers",
+          flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await scheduler.close()
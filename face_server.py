@@ -0,0 +1,175 @@
+import argparse
+import asyncio
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+
+import face_recognition
+import face_scheduler
+import face_timing
+from face_cache import RecognitionCache
+
+class FaceRequestHandler(socketserver.StreamRequestHandler):
+    """Serve newline-delimited JSON requests on one client connection"""
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                request = json.loads(line.decode('utf-8'))
+                response = face_recognition.handle_request(request)
+            except Exception as e:
+                response = json.dumps({'success': False, 'error': str(e)})
+
+            self.wfile.write((response + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+class UnixFaceServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+class TCPFaceServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def refresh_galleries(interval, compact_ratio):
+    """Background loop applying gallery changes so searches never pay for a reload
+
+    Compaction and index rebuilds happen here too; searches use the
+    previously published snapshot and index until the new ones are ready.
+    """
+    while True:
+        time.sleep(interval)
+        for gallery in list(face_recognition._galleries.values()):
+            try:
+                gallery.refresh()
+                # Rewrite the file once too many rows are tombstones
+                if gallery.deleted_count and gallery.deleted_count >= compact_ratio * len(gallery):
+                    gallery.compact()
+                face_recognition.publish_gallery(gallery)
+            except Exception as e:
+                print(f"Gallery refresh failed for {gallery.path}: {e}", file=sys.stderr, flush=True)
+
+def write_timings(path, interval):
+    """Background loop saving the stage histograms, so they survive a restart or crash"""
+    while True:
+        time.sleep(interval)
+        try:
+            face_recognition.stage_histograms.write(path)
+        except Exception as e:
+            print(f"Writing timings to {path} failed: {e}", file=sys.stderr, flush=True)
+
+def create_server(socket_path=None, port=None, socket_mode=0o660):
+    """Create a Unix socket server, or a localhost TCP server when a port is given"""
+    if port:
+        return TCPFaceServer(('127.0.0.1', port), FaceRequestHandler)
+
+    socket_path = socket_path or face_recognition.DAEMON_SOCKET
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    server = UnixFaceServer(socket_path, FaceRequestHandler)
+    os.chmod(socket_path, socket_mode)
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Long-running face recognition daemon')
+    parser.add_argument('--socket', default=face_recognition.DAEMON_SOCKET,
+                        help='Unix socket path to listen on')
+    parser.add_argument('--port', type=int, help='Listen on 127.0.0.1:PORT instead of a Unix socket')
+    parser.add_argument('--socket-mode', default='660', help='Octal permissions for the socket file')
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help='recent frames remembered by the recognition cache, 0 disables it')
+    parser.add_argument('--cache-ttl', type=float, default=5.0, help='seconds a cached recognition stays valid')
+    parser.add_argument('--cache-distance', type=int, default=6,
+                        help='maximum differing hash bits per face for two frames to count as the same')
+    parser.add_argument('--reload-interval', type=float, default=0.5,
+                        help='seconds between checks for gallery changes made by other processes')
+    parser.add_argument('--compact-ratio', type=float, default=0.25,
+                        help='compact a gallery once this share of its rows is deleted')
+    parser.add_argument('--quantize', choices=['float16', 'int8'],
+                        default=face_recognition.GALLERY_QUANTIZATION,
+                        help='keep a compact copy of stored galleries for the first distance pass of '
+                             'identify requests with many probes; float16 only saves memory')
+    parser.add_argument('--workers', type=int,
+                        help='serve through an asyncio front end and a pool of this many processes '
+                             '(0 uses one per CPU core)')
+    parser.add_argument('--max-batch', type=int, default=16, help='requests per micro-batch (--workers only)')
+    parser.add_argument('--max-wait-ms', type=float, default=5.0,
+                        help='longest wait for a micro-batch to fill (--workers only)')
+    parser.add_argument('--max-queue', type=int, default=256,
+                        help='queued requests before new ones are rejected as busy (--workers only)')
+    parser.add_argument('--deadline-ms', type=float, default=10000.0,
+                        help='default time a request may take, queueing included (--workers only)')
+    parser.add_argument('--timing-file', help='periodically write per-stage latency histograms to this file')
+    parser.add_argument('--timing-interval', type=float, default=60.0,
+                        help='seconds between writes of --timing-file')
+    parser.add_argument('--profile', type=int, metavar='N', help='profile the first N requests')
+    parser.add_argument('--profile-kind', choices=('cpu', 'memory'), default='cpu',
+                        help='cProfile (cpu) or tracemalloc (memory) for --profile')
+    parser.add_argument('--profile-output', help='report file for --profile (default: in the temp dir)')
+    face_recognition.add_encode_arguments(parser)
+    args = parser.parse_args(argv)
+
+    # Encode flags become this daemon's defaults; requests can still override them
+    for key in face_recognition.DEFAULT_ENCODE_OPTIONS:
+        if getattr(args, key) is not None:
+            face_recognition.DEFAULT_ENCODE_OPTIONS[key] = getattr(args, key)
+    face_recognition.GALLERY_QUANTIZATION = args.quantize
+
+    socket_path = args.socket or face_recognition.DAEMON_SOCKET
+    if args.workers is not None:
+        # Each pool process keeps its own galleries and checks them for changes on use
+        scheduler = face_scheduler.BatchScheduler(args.workers or None, args.max_batch, args.max_wait_ms,
+                                                  args.max_queue, args.deadline_ms, quantize=args.quantize)
+        try:
+            asyncio.run(face_scheduler.serve(scheduler, socket_path, args.port, int(args.socket_mode, 8)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if not args.port and os.path.exists(socket_path):
+                os.remove(socket_path)
+        return 0
+
+    face_recognition.auto_refresh = False
+    threading.Thread(target=refresh_galleries, args=(args.reload_interval, args.compact_ratio),
+                     daemon=True).start()
+
+    # Every request feeds the histograms; timing-stats and profile commands read and drive them
+    face_recognition.stage_histograms = face_timing.StageHistograms()
+    face_recognition.request_profiler = face_timing.RequestProfiler()
+    if args.timing_file:
+        threading.Thread(target=write_timings, args=(args.timing_file, args.timing_interval),
+                         daemon=True).start()
+    if args.profile:
+        path = face_recognition.request_profiler.start(args.profile, args.profile_kind, args.profile_output)
+        print(f"Profiling the first {args.profile} requests into {path}", flush=True)
+
+    if args.cache_size > 0:
+        face_recognition.recognition_cache = RecognitionCache(args.cache_size, args.cache_ttl,
+                                                              args.cache_distance)
+
+    # Load dlib and its models once, before the first request arrives
+    face_recognition.get_face_library()
+
+    server = create_server(args.socket, args.port, int(args.socket_mode, 8))
+    where = f"127.0.0.1:{args.port}" if args.port else args.socket
+    print(f"Face recognition daemon listening on {where}", flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if not args.port and os.path.exists(args.socket):
+            os.remove(args.socket)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+import argparse
+import json
+import sys
+import time
+
+import cv2
+
+import face_recognition
+
+def box_iou(a, b):
+    """Intersection over union of two (top, right, bottom, left) boxes"""
+    top, bottom = max(a[0], b[0]), min(a[2], b[2])
+    left, right = max(a[3], b[3]), min(a[1], b[1])
+    if bottom <= top or right <= left:
+        return 0.0
+
+    intersection = (bottom - top) * (right - left)
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    return intersection / float(area_a + area_b - intersection)
+
+class Track:
+    """One face followed across frames with a constant-velocity box estimate"""
+
+    def __init__(self, track_id, box, frame_index):
+        self.track_id = track_id
+        self.box = box
+        self.velocity = (0.0, 0.0, 0.0, 0.0)
+        self.last_seen = frame_index
+        self.encoded_box = None
+        self.match = None
+
+    def update(self, box, frame_index):
+        frames = max(1, frame_index - self.last_seen)
+        self.velocity = tuple((new - old) / float(frames) for new, old in zip(box, self.box))
+        self.box = box
+        self.last_seen = frame_index
+
+    def predict(self, frame_index):
+        """Box expected at frame_index if the face keeps moving the same way"""
+        frames = frame_index - self.last_seen
+        return tuple(int(round(v + d * frames)) for v, d in zip(self.box, self.velocity))
+
+    def needs_encoding(self, drift_iou):
+        # New tracks, and tracks that moved or resized a lot since their last encoding
+        return self.encoded_box is None or box_iou(self.box, self.encoded_box) < drift_iou
+
+class FaceStream:
+    """Detect faces every Nth frame, track them in between and encode only new or drifted tracks"""
+
+    def __init__(self, gallery_path=None, detect_every=5, drift_iou=0.5, match_iou=0.3,
+                 max_missed=2, tolerance=0.6, options=None):
+        self.gallery_path = gallery_path
+        self.detect_every = max(1, detect_every)
+        self.drift_iou = drift_iou
+        self.match_iou = match_iou
+        self.max_missed = max_missed
+        self.tolerance = tolerance
+        self.options = face_recognition.encode_options(options)
+        self.tracks = []
+        self.next_track_id = 1
+        self.stats = {'frames': 0, 'detections': 0, 'encodings': 0}
+
+    def associate(self, boxes, frame_index):
+        """Greedy IoU matching of detected boxes to predicted track boxes"""
+        pairs = sorted(((box_iou(track.predict(frame_index), box), t, b)
+                        for t, track in enumerate(self.tracks) for b, box in enumerate(boxes)),
+                       reverse=True)
+        used_tracks, used_boxes = set(), set()
+        for iou, t, b in pairs:
+            if iou < self.match_iou or t in used_tracks or b in used_boxes:
+                continue
+            self.tracks[t].update(boxes[b], frame_index)
+            used_tracks.add(t)
+            used_boxes.add(b)
+
+        for b, box in enumerate(boxes):
+            if b not in used_boxes:
+                self.tracks.append(Track(self.next_track_id, box, frame_index))
+                self.next_track_id += 1
+
+        # Forget faces that were missed by several detection passes in a row
+        horizon = self.detect_every * self.max_missed
+        self.tracks = [t for t in self.tracks if frame_index - t.last_seen <= horizon]
+
+    def identify(self, encodings):
+        if not self.gallery_path:
+            return [None] * len(encodings)
+
+        result = json.loads(face_recognition.identify_data({
+            'probes': [encoding.tolist() for encoding in encodings],
+            'gallery_path': self.gallery_path,
+            'tolerance': self.tolerance,
+            'settings': self.options
+        }))
+        if not result['success']:
+            raise RuntimeError(result['error'])
+        return [r['match'] for r in result['results']]
+
+    def process_frame(self, frame, frame_index):
+        """Handle one BGR frame and return the recognition events it produced
+
+        Frames between detection passes are only counted, so they may be
+        None when the caller did not decode them.
+        """
+        self.stats['frames'] += 1
+        if frame_index % self.detect_every:
+            return []
+
+        image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        image = face_recognition.limit_image_size(image, self.options['max_size'])
+        detections = face_recognition.detect_faces(image, self.options)
+        self.stats['detections'] += 1
+        self.associate([box for box, _ in detections], frame_index)
+
+        pending = [t for t in self.tracks if t.last_seen == frame_index and t.needs_encoding(self.drift_iou)]
+        if not pending:
+            return []
+
+        encodings = face_recognition.encode_boxes(image, [t.box for t in pending], self.options)
+        self.stats['encodings'] += len(encodings)
+
+        events = []
+        for track, match in zip(pending, self.identify(encodings)):
+            track.encoded_box = track.box
+            track.match = match
+            top, right, bottom, left = track.box
+            events.append({
+                'frame': frame_index,
+                'track_id': track.track_id,
+                'box': {'top': top, 'right': right, 'bottom': bottom, 'left': left},
+                'match': match
+            })
+        return events
+
+def open_capture(source):
+    """cv2 capture for a video file path or a numeric camera device index"""
+    capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    if not capture.isOpened():
+        raise IOError(f"Could not open video source {source}")
+    return capture
+
+def run_stream(source, stream, max_frames=None, out=sys.stdout):
+    """Feed every frame of a source through a FaceStream, writing events as JSON lines"""
+    capture = open_capture(source)
+    started = time.time()
+    frame_index = 0
+    try:
+        while max_frames is None or frame_index < max_frames:
+            # Every frame is grabbed, but only detection frames are decoded
+            if not capture.grab():
+                break
+            frame = None
+            if frame_index % stream.detect_every == 0:
+                ok, frame = capture.retrieve()
+                if not ok:
+                    break
+
+            for event in stream.process_frame(frame, frame_index):
+                event['time'] = round(time.time() - started, 3)
+                out.write(json.dumps(event) + '\n')
+                out.flush()
+            frame_index += 1
+    finally:
+        capture.release()
+
+    elapsed = time.time() - started
+    return dict(stream.stats, seconds=round(elapsed, 3),
+                fps=round(frame_index / elapsed, 2) if elapsed else None)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recognise faces in a video file or camera stream')
+    parser.add_argument('source', help='video file path or camera device index')
+    parser.add_argument('--gallery', help='gallery file to identify faces against')
+    parser.add_argument('--detect-every', type=int, default=5, help='run face detection every N frames')
+    parser.add_argument('--drift-iou', type=float, default=0.5,
+                        help='re-encode a track once its box overlaps its last encoded box less than this')
+    parser.add_argument('--tolerance', type=float, default=0.6)
+    parser.add_argument('--max-frames', type=int, help='stop after this many frames')
+    face_recognition.add_encode_arguments(parser)
+    args = parser.parse_args(argv)
+
+    options = {key: getattr(args, key) for key in face_recognition.DEFAULT_ENCODE_OPTIONS}
+    stream = FaceStream(args.gallery, args.detect_every, args.drift_iou,
+                        tolerance=args.tolerance, options=options)
+    try:
+        stats = run_stream(args.source, stream, args.max_frames)
+    except Exception as e:
+        print(json.dumps({'success': False, 'error': str(e)}))
+        return 1
+
+    print(json.dumps(dict(stats, success=True)), file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bucket bounds in milliseconds; the last bucket catches everything slower
+HISTOGRAM_BOUNDS_MS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_local = threading.local()
+
+@contextmanager
+def stage(name):
+    """Add the time spent in the block to the current request's timings, if it collects any"""
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + (time.perf_counter() - started) * 1000.0
+
+@contextmanager
+def collect():
+    """Collect the stage timings (in ms) of the code run in the block, plus its total"""
+    previous = getattr(_local, 'timings', None)
+    timings = _local.timings = {}
+    started = time.perf_counter()
+    try:
+        yield timings
+    finally:
+        timings['total'] = (time.perf_counter() - started) * 1000.0
+        _local.timings = previous
+
+class StageHistograms:
+    """Per command and stage latency histograms aggregated over many requests"""
+
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, command, timings):
+        with self._lock:
+            for name, elapsed in timings.items():
+                key = f"{command}.{name}"
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = {'count': 0, 'sum_ms': 0.0, 'max_ms': 0.0,
+                                                        'buckets': [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)}
+                histogram['count'] += 1
+                histogram['sum_ms'] += elapsed
+                histogram['max_ms'] = max(histogram['max_ms'], elapsed)
+                bucket = 0
+                while bucket < len(HISTOGRAM_BOUNDS_MS) and elapsed > HISTOGRAM_BOUNDS_MS[bucket]:
+                    bucket += 1
+                histogram['buckets'][bucket] += 1
+
+    @staticmethod
+    def percentile(histogram, share):
+        """Upper bound of the bucket holding the given share of the samples"""
+        wanted = share * histogram['count']
+        seen = 0
+        for bound, count in zip(HISTOGRAM_BOUNDS_MS, histogram['buckets']):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return histogram['max_ms']
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'bounds_ms': list(HISTOGRAM_BOUNDS_MS),
+                'stages': {key: dict(h, buckets=list(h['buckets']),
+                                     mean_ms=h['sum_ms'] / h['count'],
+                                     p50_ms=self.percentile(h, 0.5),
+                                     p95_ms=self.percentile(h, 0.95),
+                                     p99_ms=self.percentile(h, 0.99))
+                           for key, h in sorted(self.histograms.items())}
+            }
+
+    def write(self, path):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(path + '.tmp', path)
+
+class RequestProfiler:
+    """Profile the next N requests with cProfile (cpu) or tracemalloc (memory), then dump a report
+
+    Profiled requests run one at a time; all other requests are unaffected.
+    """
+
+    def __init__(self):
+        self.kind = None
+        self.remaining = 0
+        self.path = None
+        self._profile = None
+        # Reentrant: a profiled request may itself ask to start a profile
+        self._lock = threading.RLock()
+
+    def start(self, count, kind='cpu', path=None):
+        if kind not in ('cpu', 'memory'):
+            raise ValueError("Profile kind must be 'cpu' or 'memory'")
+        with self._lock:
+            if self.remaining:
+                raise RuntimeError(f"A {self.kind} profile is already running")
+            suffix = '.prof' if kind == 'cpu' else '.txt'
+            self.path = path or os.path.join(tempfile.gettempdir(),
+                                             f"face_profile_{os.getpid()}_{int(time.time())}{suffix}")
+            self.kind = kind
+            self.remaining = max(1, int(count))
+            # The profilers are only imported once someone asks for a profile
+            if kind == 'cpu':
+                import cProfile
+                self._profile = cProfile.Profile()
+            else:
+                import tracemalloc
+                tracemalloc.start(25)
+            return self.path
+
+    def run(self, fn, *args):
+        """Call fn, profiling it while a profile is running"""
+        if not self.remaining:
+            return fn(*args)
+
+        with self._lock:
+            if not self.remaining:
+                return fn(*args)
+            try:
+                if self.kind == 'cpu':
+                    return self._profile.runcall(fn, *args)
+                return fn(*args)
+            finally:
+                self.remaining -= 1
+                if not self.remaining:
+                    self._dump()
+
+    def _dump(self):
+        if self.kind == 'cpu':
+            import io
+            import pstats
+            self._profile.dump_stats(self.path)
+            # Also leave a readable summary next to the binary stats
+            summary = io.StringIO()
+            pstats.Stats(self._profile, stream=summary).sort_stats('cumulative').print_stats(40)
+            with open(self.path + '.txt', 'w') as f:
+                f.write(summary.getvalue())
+            self._profile = None
+        else:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(self.path, 'w') as f:
+                f.write(f"current {current / 1048576.0:.1f} MiB, peak {peak / 1048576.0:.1f} MiB\n\n")
+                for stat in snapshot.statistics('lineno')[:40]:
+                    f.write(f"{stat}\n")
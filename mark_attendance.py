@@ -1,12 +1,17 @@
-import csv
+import argparse
 import os
 from datetime import datetime
 import socket
 import sys
 import time
 
+from attendance_journal import current_period, default_logs_dir, segment_name
+from attendance_ready import current_user, wait_until_ready
+from attendance_segments import rotate_segments
+from attendance_views import append_csv
+
 def get_log_path():
-    """Get the path for attendance log file"""
+    """Get the path of this period's attendance log segment, archiving closed segments first"""
     if getattr(sys, 'frozen', False):
         script_dir = os.path.dirname(sys.executable)
     else:
@@ -21,7 +26,13 @@ def get_log_path():
     except Exception as e:
         logs_dir = script_dir
     
-    log_file = os.path.join(logs_dir, 'attendance_log.csv')
+    try:
+        rotate_segments(logs_dir)
+    except Exception as e:
+        # Archiving can wait for the next login; marking attendance cannot
+        write_debug_log(f"Segment rotation failed: {e}")
+    
+    log_file = os.path.join(logs_dir, segment_name('attendance_log.csv', current_period()))
     return log_file
 
 def write_debug_log(message):
@@ -38,17 +49,17 @@ def mark_attendance():
     """Mark attendance by logging login details to CSV"""
     file_path = None
     max_retries = 3
-    retry_delay = 2
+    retry_delay = 0.1
     
     try:
         write_debug_log("=== SCRIPT STARTED ===")
         write_debug_log(f"Script location: {os.path.abspath(__file__)}")
         write_debug_log(f"Working directory: {os.getcwd()}")
         
-        # Wait for system to be fully ready
-        initial_delay = 5
-        write_debug_log(f"Waiting {initial_delay} seconds for system to be ready...")
-        time.sleep(initial_delay)
+        # Wait only as long as the system is actually not ready yet
+        not_ready = wait_until_ready(default_logs_dir(), log=write_debug_log)
+        if not_ready:
+            write_debug_log(f"Still not ready, marking anyway: {', '.join(not_ready)}")
         
         file_path = get_log_path()
         write_debug_log(f"Log path: {file_path}")
@@ -60,11 +71,7 @@ def mark_attendance():
         time_str = now.strftime("%H:%M:%S")
         computer_name = socket.gethostname()
         
-        try:
-            username = os.getlogin()
-        except Exception as e:
-            write_debug_log(f"os.getlogin() failed: {e}")
-            username = os.environ.get('USER') or os.environ.get('USERNAME') or 'Unknown'
+        username = current_user() or os.environ.get('USER') or os.environ.get('USERNAME') or 'Unknown'
         
         write_debug_log(f"User: {username}, Computer: {computer_name}, Date: {date}")
         
@@ -73,62 +80,17 @@ def mark_attendance():
             try:
                 write_debug_log(f"Write attempt {attempt}/{max_retries}")
                 
-                # Check if file exists and has content
-                file_exists = os.path.exists(file_path)
-                has_content = file_exists and os.path.getsize(file_path) > 10
-                
-                write_debug_log(f"File exists: {file_exists}, Has content: {has_content}")
-                
                 # Ensure directory exists
                 os.makedirs(os.path.dirname(file_path), exist_ok=True)
                 
-                # Open file with retry
-                file_handle = None
-                for file_attempt in range(3):
-                    try:
-                        file_handle = open(file_path, 'a', newline='', encoding='utf-8')
-                        break
-                    except PermissionError:
-                        write_debug_log(f"File locked, waiting... (attempt {file_attempt + 1})")
-                        time.sleep(1)
-                
-                if not file_handle:
-                    raise Exception("Could not open file after multiple attempts")
-                
-                try:
-                    writer = csv.writer(file_handle)
-                    
-                    # Write header if new file
-                    if not has_content:
-                        write_debug_log("Writing header")
-                        writer.writerow(['Date', 'Day', 'Time', 'Computer Name', 'User', 'Event', 'Status'])
-                    
-                    # Write attendance record
-                    writer.writerow([date, day, time_str, computer_name, username, 'Login', 'Success'])
-                    write_debug_log("Attendance record written")
-                    
-                    # Force write to disk
-                    file_handle.flush()
-                    os.fsync(file_handle.fileno())
-                    write_debug_log("Data flushed to disk")
-                    
-                finally:
-                    file_handle.close()
-                    write_debug_log("File closed")
+                # One locked, fsynced append; the header is written if the file is new
+                new_size = append_csv(file_path, [[date, day, time_str, computer_name, username, 'Login', 'Success']])
+                write_debug_log("Attendance record written and flushed to disk")
                 
                 # Verify the write was successful
-                time.sleep(0.5)
                 if os.path.exists(file_path):
-                    new_size = os.path.getsize(file_path)
                     write_debug_log(f"File size after write: {new_size} bytes")
                     
-                    # Read back to verify
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        lines = f.readlines()
-                        if lines:
-                            write_debug_log(f"Total lines: {len(lines)}")
-                            write_debug_log(f"Last line: {lines[-1].strip()}")
-                    
                     print(f"✓ Attendance marked successfully!")
                     print(f"  Date: {date} ({day})")
                     print(f"  Time: {time_str}")
@@ -148,6 +110,7 @@ def mark_attendance():
                 if attempt < max_retries:
                     write_debug_log(f"Retrying in {retry_delay} seconds...")
                     time.sleep(retry_delay)
+                    retry_delay *= 2
                 else:
                     raise
         
@@ -182,6 +145,11 @@ def mark_attendance():
         return False
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Mark attendance for the logged in user')
+    parser.add_argument('--pause', type=float, nargs='?', const=10, default=0,
+                        help='keep the window open this many seconds at the end (default with the flag: 10)')
+    args = parser.parse_args()
+    
     print("="*60)
     print("ATTENDANCE MARKER - Starting...")
     print(f"Time: {datetime.now()}")
@@ -199,5 +167,6 @@ if __name__ == "__main__":
     print("="*60)
     
     # Keep window open
-    print("\nWindow will close in 10 seconds...")
-    time.sleep(10)  
\ No newline at end of file
+    if args.pause:
+        print(f"\nWindow will close in {args.pause:g} seconds...")
+        time.sleep(args.pause)  
\ No newline at end of file
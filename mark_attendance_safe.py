@@ -1,5 +1,3 @@
-import csv
-
 import os
 
 from datetime import datetime
@@ -12,11 +10,25 @@ import time
 
 import json
 
+import threading
+
+import argparse
+
+
+
+from attendance_journal import AttendanceJournal, current_period, default_logs_dir, segment_name
+
+from attendance_ready import current_user, wait_until_ready
+
+from attendance_segments import rotate_segments
+
+from attendance_views import refresh_views
+
 
 
 def get_log_paths():
 
-    """Get paths for both CSV and backup JSON log files"""
+    """Get paths of this period's CSV, JSON and TXT log segments, archiving closed segments first"""
 
     if getattr(sys, 'frozen', False):
 
@@ -46,11 +58,25 @@ def get_log_paths():
 
     
 
-    csv_file = os.path.join(logs_dir, 'attendance_log.csv')
+    try:
+
+        rotate_segments(logs_dir)
+
+    except Exception as e:
+
+        # Archiving can wait for the next login; marking attendance cannot
+
+        write_debug_log(f"Segment rotation failed: {e}")
+
+    
+
+    period = current_period()
 
-    json_file = os.path.join(logs_dir, 'attendance_log.json')
+    csv_file = os.path.join(logs_dir, segment_name('attendance_log.csv', period))
 
-    txt_file = os.path.join(logs_dir, 'attendance_log.txt')
+    json_file = os.path.join(logs_dir, segment_name('attendance_log.json', period))
+
+    txt_file = os.path.join(logs_dir, segment_name('attendance_log.txt', period))
 
     
 
@@ -78,9 +104,31 @@ def write_debug_log(message):
 
 
 
+def update_logs(journal):
+
+    """Bring this period's TXT and CSV logs up to date with the journal and compact it now and then"""
+
+    try:
+
+        added = refresh_views(journal.logs_dir, journal.period)
+
+        write_debug_log(f"âœ“ TXT and CSV logs updated ({added} records)")
+
+        # Every so often fold the journal into its snapshot so reads stay quick
+
+        journal.maybe_compact()
+
+    except Exception as e:
+
+        # The records stay in the journal; the next login or attendance_views.py catches the logs up
+
+        write_debug_log(f"âœ— Log update error: {e}")
+
+
+
 def mark_attendance():
 
-    """Mark attendance using multiple file formats for redundancy"""
+    """Mark attendance with one durable journal write; the TXT and CSV logs follow in the background"""
 
     try:
 
@@ -92,7 +140,11 @@ def mark_attendance():
 
         
 
-        time.sleep(2)
+        not_ready = wait_until_ready(default_logs_dir(), log=write_debug_log)
+
+        if not_ready:
+
+            write_debug_log(f"Still not ready, marking anyway: {', '.join(not_ready)}")
 
         
 
@@ -120,13 +172,7 @@ def mark_attendance():
 
         
 
-        try:
-
-            username = os.getlogin()
-
-        except:
-
-            username = os.environ.get('USER') or os.environ.get('USERNAME') or 'Unknown'
+        username = current_user() or os.environ.get('USER') or os.environ.get('USERNAME') or 'Unknown'
 
         
 
@@ -156,179 +202,41 @@ def mark_attendance():
 
         
 
-        success_count = 0
-
-        
-
-        # METHOD 1: Write to plain text file (most reliable)
-
-        try:
-
-            with open(txt_path, 'a', encoding='utf-8') as f:
-
-                if os.path.getsize(txt_path) == 0 if os.path.exists(txt_path) else True:
-
-                    f.write("="*80 + "\n")
-
-                    f.write("ATTENDANCE LOG\n")
-
-                    f.write("="*80 + "\n\n")
-
-                
-
-                f.write(f"Date: {date} ({day})\n")
-
-                f.write(f"Time: {time_str}\n")
-
-                f.write(f"User: {username}\n")
-
-                f.write(f"Computer: {computer_name}\n")
-
-                f.write(f"Event: Login\n")
-
-                f.write(f"Status: Success\n")
-
-                f.write("-"*80 + "\n\n")
-
-                f.flush()
-
-                os.fsync(f.fileno())
-
-            
-
-            txt_size = os.path.getsize(txt_path)
-
-            write_debug_log(f"âœ“ TXT file written successfully ({txt_size} bytes)")
-
-            success_count += 1
-
-        except Exception as e:
-
-            write_debug_log(f"âœ— TXT file error: {e}")
-
-        
-
-        # METHOD 2: Write to JSON file (structured, Excel-safe)
-
-        try:
-
-            records = []
-
-            if os.path.exists(json_path) and os.path.getsize(json_path) > 0:
-
-                with open(json_path, 'r', encoding='utf-8') as f:
-
-                    records = json.load(f)
+        # The journal is the one durable write; the TXT and CSV logs are brought up to date from it afterwards
 
-            
+        logs_dir = os.path.dirname(json_path)
 
-            records.append(record)
+        journal = AttendanceJournal(logs_dir)
 
-            
+        legacy_journal = AttendanceJournal(logs_dir, period='')
 
-            with open(json_path, 'w', encoding='utf-8') as f:
+        legacy_json = os.path.join(logs_dir, 'attendance_log.json')
 
-                json.dump(records, f, indent=2, ensure_ascii=False)
+        if not legacy_journal.exists() and os.path.exists(legacy_json) and os.path.getsize(legacy_json) > 0:
 
-                f.flush()
+            # First run with the journal: carry over the history kept in the old JSON file
 
-                os.fsync(f.fileno())
+            with open(legacy_json, 'r', encoding='utf-8') as f:
 
-            
+                legacy_journal.append_many(json.load(f))
 
-            json_size = os.path.getsize(json_path)
+            legacy_journal.close()
 
-            write_debug_log(f"âœ“ JSON file written successfully ({json_size} bytes, {len(records)} records)")
-
-            success_count += 1
-
-        except Exception as e:
-
-            write_debug_log(f"âœ— JSON file error: {e}")
+            write_debug_log(f"Imported {legacy_json} into the journal")
 
         
 
-        # METHOD 3: Write to CSV file (for Excel compatibility)
-
-        try:
-
-            csv_exists = os.path.exists(csv_path) and os.path.getsize(csv_path) > 10
-
-            
-
-            # Use a temporary file first, then rename (atomic operation)
-
-            temp_csv = csv_path + '.tmp'
-
-            
-
-            with open(temp_csv, 'a', newline='', encoding='utf-8') as f:
-
-                writer = csv.writer(f)
-
-                
-
-                if not csv_exists:
-
-                    writer.writerow(['Date', 'Day', 'Time', 'Computer Name', 'User', 'Event', 'Status'])
-
-                
-
-                writer.writerow([date, day, time_str, computer_name, username, 'Login', 'Success'])
-
-                f.flush()
-
-                os.fsync(f.fileno())
-
-            
+        journal.append(record)
 
-            # Replace the original file
+        journal.close()
 
-            if os.path.exists(csv_path):
-
-                os.remove(csv_path)
-
-            os.rename(temp_csv, csv_path)
-
-            
-
-            csv_size = os.path.getsize(csv_path)
-
-            write_debug_log(f"âœ“ CSV file written successfully ({csv_size} bytes)")
-
-            success_count += 1
-
-        except Exception as e:
-
-            write_debug_log(f"âœ— CSV file error: {e}")
-
-            # Clean up temp file if it exists
-
-            if os.path.exists(temp_csv):
-
-                try:
-
-                    os.remove(temp_csv)
-
-                except:
-
-                    pass
+        write_debug_log(f"âœ“ Journal record appended ({journal.path})")
 
         
 
-        # Verify files exist and have content
-
-        for path, name in [(txt_path, 'TXT'), (json_path, 'JSON'), (csv_path, 'CSV')]:
-
-            if os.path.exists(path):
+        # Not waited for: the record is already safe in the journal
 
-                size = os.path.getsize(path)
-
-                write_debug_log(f"{name} file exists: {size} bytes")
-
-            else:
-
-                write_debug_log(f"{name} file NOT FOUND")
+        threading.Thread(target=update_logs, args=(journal,)).start()
 
         
 
@@ -342,25 +250,23 @@ def mark_attendance():
 
         print(f"  Computer: {computer_name}")
 
-        print(f"  Files written: {success_count}/3")
-
         print(f"\n  Log files:")
 
-        print(f"    TXT: {txt_path}")
+        print(f"    Journal: {journal.path}")
 
-        print(f"    JSON: {json_path}")
+        print(f"    TXT: {txt_path}")
 
         print(f"    CSV: {csv_path}")
 
-        
+        print(f"    JSON: export with attendance_views.py --json")
 
-        write_debug_log(f"Successfully wrote to {success_count}/3 files")
+        
 
         write_debug_log("=== SCRIPT COMPLETED SUCCESSFULLY ===\n")
 
         
 
-        return success_count > 0
+        return True
 
         
 
@@ -414,6 +320,16 @@ def mark_attendance():
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description='Mark attendance for the logged in user')
+
+    parser.add_argument('--pause', type=float, nargs='?', const=10, default=0,
+
+                        help='keep the window open this many seconds at the end (default with the flag: 10)')
+
+    args = parser.parse_args()
+
+    
+
     print("="*60)
 
     print("ATTENDANCE MARKER - Starting...")
@@ -444,6 +360,8 @@ if __name__ == "__main__":
 
     
 
-    print("\nWindow will close in 10 seconds...")
+    if args.pause:
+
+        print(f"\nWindow will close in {args.pause:g} seconds...")
 
-    time.sleep(10)
\ No newline at end of file
+        time.sleep(args.pause)
\ No newline at end of file